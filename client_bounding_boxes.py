@@ -42,8 +42,13 @@ except IndexError:
 
 import carla
 
+import argparse
+import json
+import threading
+import time
 import weakref
 import random
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import pygame
@@ -67,6 +72,20 @@ VIEW_FOV = 90
 
 BB_COLOR = (248, 64, 24)
 
+# Signs of the 8 corners relative to the extent, same order as _create_bb_points
+BB_CORNER_SIGNS = np.array([
+    [1, 1, -1], [-1, 1, -1], [-1, -1, -1], [1, -1, -1],
+    [1, 1, 1], [-1, 1, 1], [-1, -1, 1], [1, -1, 1]])
+
+# Corners visited by one polyline that passes all 12 edges of a box
+BB_EDGE_PATH = [0, 1, 2, 3, 0, 4, 5, 1, 5, 6, 2, 6, 7, 3, 7, 4]
+
+# Sensor x, y, z to the camera axes y, -z, x, as homogeneous 3x4
+SENSOR_TO_CAMERA = np.array([
+    [0, 1, 0, 0],
+    [0, 0, -1, 0],
+    [1, 0, 0, 0]], dtype=np.float64)
+
 # ==============================================================================
 # -- ClientSideBoundingBoxes ---------------------------------------------------
 # ==============================================================================
@@ -79,20 +98,139 @@ class ClientSideBoundingBoxes(object):
     """
 
     @staticmethod
-    def get_bounding_boxes(vehicles, camera):
+    def get_bounding_boxes(vehicles, camera, max_distance=None, stats=None, cache=None):
         """
         Creates 3D bounding boxes based on carla vehicle list and camera.
+        All vehicles are projected at once, the result is a (N, 8, 3) array
+        of x, y, depth per corner. See get_bounding_box for a single vehicle.
         """
 
-        bounding_boxes = [ClientSideBoundingBoxes.get_bounding_box(vehicle, camera) for vehicle in vehicles]
-        # filter objects behind camera
-        # bb[:, 2]: It selects the third column (index 2) of the bounding box.
-        # bb[:, 2] > 0: It creates a boolean array indicating whether each value in the third column is greater than zero.
-        # all(bb[:, 2] > 0): It checks if all values in the boolean array are True. 
-        # If any value is False, the bounding box is excluded from the filtered list.
-        bounding_boxes = [bb for bb in bounding_boxes if all(bb[:, 2] > 0)]
+        bounding_boxes, _ = ClientSideBoundingBoxes.project_bounding_boxes(vehicles, camera, max_distance, stats, cache)
         return bounding_boxes
 
+    @staticmethod
+    def project_bounding_boxes(vehicles, camera, max_distance=None, stats=None, cache=None, frustum=True):
+        """
+        Same as get_bounding_boxes, also returns the index into vehicles of every box.
+        Vehicles farther than max_distance from the camera or, with frustum, outside
+        its view are culled before the projection. The number of culled vehicles per
+        stage is added to the stats dict, if given. With a BoundingBoxCache
+        the corners of a vehicle are only created once.
+        """
+
+        vehicles = list(vehicles)
+        indices = np.arange(len(vehicles))
+        if not vehicles:
+            return np.zeros((0, 8, 3)), indices
+        if cache is not None:
+            bb_cords = cache.get(vehicles)
+        else:
+            bb_cords = ClientSideBoundingBoxes._create_bb_points_batch(vehicles)
+        vehicle_world_matrices = ClientSideBoundingBoxes.get_matrices([vehicle.get_transform() for vehicle in vehicles])
+        # The camera matrix is inverted once per frame
+        world_sensor_matrix = np.linalg.inv(np.asarray(ClientSideBoundingBoxes.get_matrix(camera.get_transform())))
+
+        counts = {'vehicles': len(vehicles)}
+        visible = ClientSideBoundingBoxes._cull(
+            bb_cords, vehicle_world_matrices, world_sensor_matrix, camera.calibration, max_distance, counts, frustum)
+        indices = indices[visible]
+        bounding_boxes = ClientSideBoundingBoxes._project(
+            bb_cords[visible], vehicle_world_matrices[visible], world_sensor_matrix, camera.calibration)
+
+        # filter objects behind camera
+        # bounding_boxes[:, :, 2] is the depth of every corner, a box is kept
+        # only if all 8 corners are in front of the camera.
+        in_front = np.all(bounding_boxes[:, :, 2] > 0, axis=1)
+        counts['behind_camera'] = len(in_front) - int(in_front.sum())
+        bounding_boxes, indices = bounding_boxes[in_front], indices[in_front]
+
+        # Drop boxes whose 2D extent does not overlap the image, pygame clips the rest
+        width, height = 2.0 * camera.calibration[0, 2], 2.0 * camera.calibration[1, 2]
+        in_image = ((bounding_boxes[:, :, 0].max(axis=1) >= 0) & (bounding_boxes[:, :, 0].min(axis=1) < width) &
+                    (bounding_boxes[:, :, 1].max(axis=1) >= 0) & (bounding_boxes[:, :, 1].min(axis=1) < height))
+        counts['outside_image'] = len(in_image) - int(in_image.sum())
+        bounding_boxes, indices = bounding_boxes[in_image], indices[in_image]
+        counts['projected'] = len(bounding_boxes)
+
+        if stats is not None:
+            for key, value in counts.items():
+                stats[key] = stats.get(key, 0) + value
+        return bounding_boxes, indices
+
+    @staticmethod
+    def _cull(cords, vehicle_world_matrices, world_sensor_matrix, calibration, max_distance, counts, frustum=True):
+        """
+        Returns a mask of the vehicles whose bounding sphere is closer than
+        max_distance and, with frustum, intersects the view frustum of the camera.
+        """
+
+        # Bounding sphere of every box in the sensor frame, x forward, y right, z up
+        centers = np.einsum('ij,njk,nk->ni', world_sensor_matrix, vehicle_world_matrices, cords.mean(axis=1),
+                            optimize=True)[:, :3]
+        radius = np.linalg.norm(cords[:, 0, :3] - cords[:, 6, :3], axis=1) / 2.0
+
+        visible = np.ones(len(cords), dtype=bool)
+        if max_distance:
+            visible &= np.linalg.norm(centers, axis=1) - radius <= max_distance
+        counts['distance_culled'] = len(cords) - int(visible.sum())
+        if not frustum:
+            counts['frustum_culled'] = 0
+            return visible
+
+        # Half of the horizontal and vertical field of view from the calibration
+        tan_h = calibration[0, 2] / calibration[0, 0]
+        tan_v = calibration[1, 2] / calibration[1, 1]
+        x, y, z = centers.T
+        in_frustum = ((x >= -radius) &
+                      (np.abs(y) - x * tan_h <= radius * np.sqrt(1.0 + tan_h ** 2)) &
+                      (np.abs(z) - x * tan_v <= radius * np.sqrt(1.0 + tan_v ** 2)))
+        counts['frustum_culled'] = int((visible & ~in_frustum).sum())
+        return visible & in_frustum
+
+    @staticmethod
+    def _project(cords, vehicle_world_matrices, world_sensor_matrix, calibration):
+        """
+        Projects (N, 8, 4) bounding box points in the vehicle frames onto the
+        camera image, vehicle_world_matrices are the (N, 4, 4) vehicle to world matrices.
+        """
+
+        # The world to sensor matrix is folded into one 3x4 world to image
+        # projection together with the calibration
+        projection = np.dot(calibration, np.dot(SENSOR_TO_CAMERA, world_sensor_matrix))
+        bbox = np.einsum('ij,njk,nck->nci', projection, vehicle_world_matrices, cords, optimize=True)
+        depth = bbox[:, :, 2:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.concatenate([bbox[:, :, :2] / depth, depth], axis=2)
+
+    @staticmethod
+    def get_rects(bounding_boxes, width, height):
+        """
+        Returns the (N, 4) xmin, ymin, xmax, ymax 2D rectangles enclosing the
+        projected boxes, clipped to the image.
+        """
+
+        rects = np.concatenate([bounding_boxes[:, :, :2].min(axis=1), bounding_boxes[:, :, :2].max(axis=1)], axis=1)
+        return np.clip(rects, 0, [width, height] * 2)
+
+    @staticmethod
+    def get_visible_fraction(bounding_boxes, depth, samples=8, tolerance=1.0):
+        """
+        Returns the fraction of a samples x samples grid inside the 2D rectangle
+        of every box where the depth image is not closer than the nearest corner
+        of the box, i.e. where nothing is in front of the vehicle. depth is the
+        (H, W) depth image in meters, see decode_depth.
+        """
+
+        height, width = depth.shape
+        rects = ClientSideBoundingBoxes.get_rects(bounding_boxes, width - 1, height - 1)
+        steps = (np.arange(samples) + 0.5) / samples
+        columns = (rects[:, 0:1] + steps * (rects[:, 2:3] - rects[:, 0:1])).astype(np.intp)
+        rows = (rects[:, 1:2] + steps * (rects[:, 3:4] - rects[:, 1:2])).astype(np.intp)
+        # (N, samples, samples) depth of the scene at the grid of every box
+        scene_depth = depth[rows[:, :, None], columns[:, None, :]]
+        nearest = bounding_boxes[:, :, 2].min(axis=1)
+        return (scene_depth >= nearest[:, None, None] - tolerance).mean(axis=(1, 2))
+
     @staticmethod
     def draw_bounding_boxes(display, bounding_boxes):
         """
@@ -164,6 +302,21 @@ class ClientSideBoundingBoxes(object):
         cords[7, :] = np.array([extent.x, -extent.y, extent.z, 1])
         return cords
 
+    @staticmethod
+    def _create_bb_points_batch(vehicles):
+        """
+        Returns (N, 8, 4) 3D bounding boxes for N vehicles. Unlike _create_bb_points
+        the bounding box location is already added, the points are in the vehicle frame.
+        """
+
+        extents = np.array([[bb.extent.x, bb.extent.y, bb.extent.z]
+                            for bb in (vehicle.bounding_box for vehicle in vehicles)])
+        locations = np.array([[bb.location.x, bb.location.y, bb.location.z]
+                              for bb in (vehicle.bounding_box for vehicle in vehicles)])
+        cords = np.ones((len(vehicles), 8, 4))
+        cords[:, :, :3] = BB_CORNER_SIGNS * extents[:, None, :] + locations[:, None, :]
+        return cords
+
     @staticmethod
     def _vehicle_to_sensor(cords, vehicle, sensor):
         """
@@ -238,6 +391,221 @@ class ClientSideBoundingBoxes(object):
         matrix[2, 2] = c_p * c_r
         return matrix
 
+    @staticmethod
+    def get_matrices(transforms):
+        """
+        Creates a (N, 4, 4) array of matrices from N carla transforms, same as get_matrix.
+        """
+
+        rotations = np.radians([[t.rotation.pitch, t.rotation.yaw, t.rotation.roll] for t in transforms])
+        c_p, c_y, c_r = np.cos(rotations).T
+        s_p, s_y, s_r = np.sin(rotations).T
+        matrices = np.zeros((len(transforms), 4, 4))
+        matrices[:, :3, 3] = [[t.location.x, t.location.y, t.location.z] for t in transforms]
+        matrices[:, 3, 3] = 1
+        matrices[:, 0, 0] = c_p * c_y
+        matrices[:, 0, 1] = c_y * s_p * s_r - s_y * c_r
+        matrices[:, 0, 2] = -c_y * s_p * c_r - s_y * s_r
+        matrices[:, 1, 0] = s_y * c_p
+        matrices[:, 1, 1] = s_y * s_p * s_r + c_y * c_r
+        matrices[:, 1, 2] = -s_y * s_p * c_r + c_y * s_r
+        matrices[:, 2, 0] = s_p
+        matrices[:, 2, 1] = -c_p * s_r
+        matrices[:, 2, 2] = c_p * c_r
+        return matrices
+
+
+def decode_depth(image):
+    """
+    Returns the depth in meters of a sensor.camera.depth image as (H, W) array.
+    """
+
+    array = np.frombuffer(image.raw_data, dtype=np.dtype("uint8"))
+    array = np.reshape(array, (image.height, image.width, 4)).astype(np.float32)
+    # BGRA, depth is encoded in 24 bit as R + G * 256 + B * 256 * 256 over 1000 m
+    normalized = np.dot(array[:, :, 2::-1], np.array([1.0, 256.0, 65536.0], dtype=np.float32)) / (256.0 ** 3 - 1)
+    return 1000.0 * normalized
+
+
+def camera_calibration(width=VIEW_WIDTH, height=VIEW_HEIGHT, fov=VIEW_FOV):
+    """
+    Returns the 3x3 intrinsic matrix of a pinhole camera.
+    """
+
+    # 3x3 单位矩阵
+    calibration = np.identity(3)
+    calibration[0, 2] = width / 2.0
+    calibration[1, 2] = height / 2.0
+    # pinhole camera model
+    calibration[0, 0] = calibration[1, 1] = width / (2.0 * np.tan(fov * np.pi / 360.0))
+    return calibration
+
+
+class BoundingBoxRenderer(object):
+    """
+    Draws bounding boxes onto one overlay surface that is kept between frames,
+    or with overlay=False straight onto the display, which skips the colorkey
+    blit of the overlay. The corners of all boxes are converted to pixels at
+    once and every box is a single polyline instead of 12 lines.
+    """
+
+    def __init__(self, width=VIEW_WIDTH, height=VIEW_HEIGHT, color=BB_COLOR, overlay=True):
+        self.color = color
+        self.surface = None
+        if overlay:
+            self.surface = pygame.Surface((width, height))
+            self.surface.set_colorkey((0, 0, 0))
+        # Area of the overlay drawn in the last frame, only this part is cleared and blitted
+        self.dirty = None
+
+    def draw(self, display, bounding_boxes):
+        if self.dirty is not None:
+            self.surface.fill((0, 0, 0), self.dirty)
+            self.dirty = None
+        if len(bounding_boxes) == 0:
+            return
+        target = display if self.surface is None else self.surface
+        # Corners of boxes close to the camera can be far outside the image,
+        # the clip only keeps them in the integer range, pygame clips the lines
+        points = np.clip(np.asarray(bounding_boxes)[:, BB_EDGE_PATH, :2], -2 ** 30, 2 ** 30).astype(np.int32)
+        rects = [pygame.draw.lines(target, self.color, False, polyline) for polyline in points.tolist()]
+        if self.surface is not None:
+            self.dirty = rects[0].unionall(rects[1:])
+            display.blit(self.surface, self.dirty.topleft, self.dirty)
+
+
+class BoundingBoxCache(object):
+    """
+    Bounding box corners in the vehicle frame keyed by actor id. Extent and
+    location of the bounding box are constant for the lifetime of an actor,
+    so only the vehicle transform has to be fetched every frame. The location
+    is the only part of the local bounding box transform, it is already added
+    to the cached corners.
+    """
+
+    def __init__(self):
+        self._cords = {}
+
+    def __len__(self):
+        return len(self._cords)
+
+    def get(self, vehicles):
+        """
+        Returns the (N, 8, 4) corners of vehicles, creating the missing ones.
+        """
+
+        missing = [vehicle for vehicle in vehicles if vehicle.id not in self._cords]
+        if missing:
+            cords = ClientSideBoundingBoxes._create_bb_points_batch(missing)
+            self._cords.update(zip([vehicle.id for vehicle in missing], cords))
+        return np.stack([self._cords[vehicle.id] for vehicle in vehicles])
+
+    def retain(self, vehicles):
+        """
+        Evicts the corners of all actors that are not in vehicles, i.e. destroyed ones.
+        """
+
+        if len(self._cords) > len(vehicles) or any(vehicle.id not in self._cords for vehicle in vehicles):
+            alive = set(vehicle.id for vehicle in vehicles)
+            for actor_id in [actor_id for actor_id in self._cords if actor_id not in alive]:
+                del self._cords[actor_id]
+
+
+class AnnotationWriter(object):
+    """
+    Streams camera images and their projected bounding boxes into a dataset
+    directory. Every frame is one line of an append-only annotations_NNNNN.jsonl
+    shard, a new shard is started every frames_per_shard frames. Each box has
+    the actor id, the 8 projected corners with their depths and the enclosing
+    2D rectangle clipped to the image. Images are saved to images/ by a thread
+    pool and the shards are written by a single thread, so write() does not
+    wait for the disk. At most max_pending frames are queued, further frames
+    are dropped and counted in dropped instead of growing the memory when the
+    disk is too slow. A directory holds a single dataset, one that already
+    has shards or images is refused instead of being appended to.
+    """
+
+    def __init__(self, directory, frames_per_shard=1000, image_workers=4, image_format='png', max_pending=64):
+        if AnnotationWriter.has_dataset(directory):
+            raise ValueError('%s already holds an annotation dataset, export into a new directory' % directory)
+        self.directory = directory
+        self.frames_per_shard = frames_per_shard
+        self.image_format = image_format
+        self.max_pending = max_pending
+        self.written = 0
+        self.dropped = 0
+        # Image saves and shard lines not written yet, two per frame
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._shard = None
+        self._image_executor = ThreadPoolExecutor(max_workers=image_workers)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(os.path.join(directory, 'images'), exist_ok=True)
+
+    @staticmethod
+    def has_dataset(directory):
+        images = os.path.join(directory, 'images')
+        return bool(glob.glob(os.path.join(directory, 'annotations_*.jsonl')) or
+                    (os.path.isdir(images) and os.listdir(images)))
+
+    def _done(self, future):
+        with self._pending_lock:
+            self._pending -= 1
+
+    def write(self, image, bounding_boxes, actor_ids, visibility=None):
+        """
+        image is the carla.Image the (N, 8, 3) bounding_boxes were projected on,
+        visibility the optional visible fraction of every box.
+        """
+
+        with self._pending_lock:
+            if self._pending >= 2 * self.max_pending:
+                self.dropped += 1
+                return
+            self._pending += 2
+        image_file = os.path.join('images', '%08d.%s' % (image.frame, self.image_format))
+        self._image_executor.submit(image.save_to_disk, os.path.join(self.directory, image_file)).add_done_callback(self._done)
+        entry = {
+            'frame': image.frame,
+            'timestamp': image.timestamp,
+            'image': image_file,
+            'width': image.width,
+            'height': image.height}
+        shard = self.written // self.frames_per_shard
+        self._executor.submit(self._append, shard, entry, np.array(bounding_boxes), list(actor_ids),
+                              None if visibility is None else np.array(visibility)).add_done_callback(self._done)
+        self.written += 1
+
+    def _append(self, shard, entry, bounding_boxes, actor_ids, visibility):
+        if self._shard is None or self._shard[0] != shard:
+            if self._shard is not None:
+                self._shard[1].close()
+            path = os.path.join(self.directory, 'annotations_%05d.jsonl' % shard)
+            self._shard = (shard, open(path, 'w'))
+        rects = ClientSideBoundingBoxes.get_rects(bounding_boxes, entry['width'], entry['height'])
+        entry['boxes'] = [{
+            'actor_id': actor_id,
+            'corners': corners,
+            'depths': depths,
+            'rect': rect} for actor_id, corners, depths, rect in zip(
+                actor_ids, np.round(bounding_boxes[:, :, :2], 2).tolist(), np.round(bounding_boxes[:, :, 2], 3).tolist(),
+                np.round(rects, 2).tolist())]
+        if visibility is not None:
+            for box, visible in zip(entry['boxes'], np.round(visibility, 3).tolist()):
+                box['visible'] = visible
+        self._shard[1].write(json.dumps(entry) + '\n')
+
+    def close(self):
+        """
+        Waits for all pending images and annotations.
+        """
+
+        self._image_executor.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+        if self._shard is not None:
+            self._shard[1].close()
+            self._shard = None
+
 
 # ==============================================================================
 # -- BasicSynchronousClient ----------------------------------------------------
@@ -249,22 +617,30 @@ class BasicSynchronousClient(object):
     Basic implementation of a synchronous client.
     """
 
-    def __init__(self):
+    def __init__(self, args):
+        self.args = args
         self.client = None
         self.world = None
         self.camera = None
+        self.depth_camera = None
         self.car = None
 
         self.display = None
         self.image = None
+        self.depth_image = None
         self.capture = True
+        # Culled vehicle counts of all frames, see get_bounding_boxes
+        self.cull_stats = {}
+        self.bb_cache = BoundingBoxCache()
+        self.bb_renderer = None
+        self.annotation_writer = None
 
-    def camera_blueprint(self):
+    def camera_blueprint(self, sensor='sensor.camera.rgb'):
         """
         Returns camera blueprint.
         """
 
-        camera_bp = self.world.get_blueprint_library().find('sensor.camera.rgb')
+        camera_bp = self.world.get_blueprint_library().find(sensor)
         camera_bp.set_attribute('image_size_x', str(VIEW_WIDTH))
         camera_bp.set_attribute('image_size_y', str(VIEW_HEIGHT))
         camera_bp.set_attribute('fov', str(VIEW_FOV))
@@ -300,13 +676,13 @@ class BasicSynchronousClient(object):
         weak_self = weakref.ref(self)
         self.camera.listen(lambda image: weak_self().set_image(weak_self, image))
 
-        # 3x3 单位矩阵
-        calibration = np.identity(3)
-        calibration[0, 2] = VIEW_WIDTH / 2.0
-        calibration[1, 2] = VIEW_HEIGHT / 2.0
-        # pinhole camera model
-        calibration[0, 0] = calibration[1, 1] = VIEW_WIDTH / (2.0 * np.tan(VIEW_FOV * np.pi / 360.0))
-        self.camera.calibration = calibration
+        self.camera.calibration = camera_calibration()
+
+        if self.args.occlusion:
+            # Same pose and intrinsics as the rgb camera, for the visibility test of the boxes
+            self.depth_camera = self.world.spawn_actor(
+                self.camera_blueprint('sensor.camera.depth'), camera_transform, attach_to=self.car)
+            self.depth_camera.listen(lambda image: weak_self().set_depth_image(weak_self, image))
 
     def control(self, car):
         """
@@ -350,6 +726,15 @@ class BasicSynchronousClient(object):
             self.image = img
             self.capture = False
 
+    @staticmethod
+    def set_depth_image(weak_self, img):
+        """
+        Sets the latest image of the depth camera.
+        """
+
+        self = weak_self()
+        self.depth_image = img
+
     def render(self, display):
         """
         Transforms image from camera sensor and blits it to main pygame display.
@@ -380,13 +765,21 @@ class BasicSynchronousClient(object):
 
             self.display = pygame.display.set_mode((VIEW_WIDTH, VIEW_HEIGHT), pygame.HWSURFACE | pygame.DOUBLEBUF)
             pygame_clock = pygame.time.Clock()
+            if self.args.render_mode != 'per-edge':
+                self.bb_renderer = BoundingBoxRenderer(overlay=self.args.render_mode == 'overlay')
+
+            if self.args.annotations:
+                self.annotation_writer = AnnotationWriter(
+                    self.args.annotations, frames_per_shard=self.args.annotation_shard_frames)
 
             self.set_synchronous_mode(True)
-            vehicles = self.world.get_actors().filter('vehicle.*')
 
             while True:
                 # Advances the world simulation by one tick.
-                self.world.tick()
+                frame = self.world.tick()
+                # Vehicles may be spawned or destroyed at any time
+                vehicles = list(self.world.get_actors().filter('vehicle.*'))
+                self.bb_cache.retain(vehicles)
 
                 self.capture = True
                 # Limits the frame rate to 20 frames per second.
@@ -395,8 +788,30 @@ class BasicSynchronousClient(object):
                 # Renders the scene on the display.
                 self.render(self.display)
 
-                bounding_boxes = ClientSideBoundingBoxes.get_bounding_boxes(vehicles, self.camera)
-                ClientSideBoundingBoxes.draw_bounding_boxes(self.display, bounding_boxes)
+                bounding_boxes, indices = ClientSideBoundingBoxes.project_bounding_boxes(
+                    vehicles, self.camera, self.args.max_distance, self.cull_stats, self.bb_cache)
+                visibility = None
+                depth_image = self.depth_image
+                # With --occlusion a frame is only filtered and exported if the depth image belongs to it,
+                # otherwise the dataset would mix filtered and unfiltered frames
+                depth_matches = depth_image is not None and depth_image.frame == frame
+                if depth_matches:
+                    # Drop boxes of vehicles hidden behind other objects
+                    visibility = ClientSideBoundingBoxes.get_visible_fraction(
+                        bounding_boxes, decode_depth(depth_image), tolerance=self.args.occlusion_tolerance)
+                    visible = visibility >= self.args.min_visible
+                    self.cull_stats['occluded'] = self.cull_stats.get('occluded', 0) + len(visible) - int(visible.sum())
+                    bounding_boxes, indices, visibility = bounding_boxes[visible], indices[visible], visibility[visible]
+
+                # Only frames whose image matches the projected transforms are exported
+                if (self.annotation_writer is not None and self.image is not None and self.image.frame == frame
+                        and (depth_matches or self.depth_camera is None)):
+                    self.annotation_writer.write(
+                        self.image, bounding_boxes, [vehicles[i].id for i in indices], visibility)
+                if self.bb_renderer is not None:
+                    self.bb_renderer.draw(self.display, bounding_boxes)
+                else:
+                    ClientSideBoundingBoxes.draw_bounding_boxes(self.display, bounding_boxes)
 
                 # Updates the display to show the rendered frame.
                 pygame.display.flip()
@@ -407,12 +822,155 @@ class BasicSynchronousClient(object):
                     return
 
         finally:
+            print(format_cull_stats(self.cull_stats))
+            if self.annotation_writer is not None:
+                self.annotation_writer.close()
+                print('wrote %d annotated frames to %s, dropped %d for a slow disk' % (
+                    self.annotation_writer.written, self.args.annotations, self.annotation_writer.dropped))
             self.set_synchronous_mode(False)
             self.camera.destroy()
+            if self.depth_camera is not None:
+                self.depth_camera.destroy()
             self.car.destroy()
             pygame.quit()
 
 
+# ==============================================================================
+# -- benchmark -----------------------------------------------------------------
+# ==============================================================================
+
+
+class SyntheticActor(object):
+    """
+    Stand-in for a carla vehicle or camera, only holds a transform.
+    """
+
+    def __init__(self, transform, bounding_box=None, actor_id=0):
+        self.id = actor_id
+        self.transform = transform
+        self.bounding_box = bounding_box
+
+    def get_transform(self):
+        return self.transform
+
+
+def generate_synthetic_vehicles(num_vehicles, rng):
+    """
+    Places vehicles with random poses and sizes around the origin.
+    """
+
+    vehicles = []
+    for actor_id in range(num_vehicles):
+        x, y = rng.uniform(-100.0, 100.0, 2)
+        extent = carla.Vector3D(*rng.uniform([1.5, 0.8, 0.6], [3.0, 1.2, 1.2]))
+        vehicles.append(SyntheticActor(
+            carla.Transform(carla.Location(x=x, y=y, z=0.0), carla.Rotation(yaw=rng.uniform(-180.0, 180.0))),
+            carla.BoundingBox(carla.Location(z=extent.z), extent), actor_id))
+    return vehicles
+
+
+def benchmark(args):
+    """
+    Compares the per-vehicle, batched and cached projection on synthetic vehicles.
+    The three are timed without culling, the gain of culling with --max-distance
+    and the view frustum is reported on top of the cached projection.
+    """
+
+    rng = np.random.default_rng(0)
+    camera = SyntheticActor(carla.Transform(carla.Location(x=-5.5, z=2.8), carla.Rotation(pitch=-15)))
+    camera.calibration = camera_calibration()
+
+    for num_vehicles in [int(n) for n in args.benchmark_actors.split(',')]:
+        vehicles = generate_synthetic_vehicles(num_vehicles, rng)
+
+        def per_vehicle():
+            bounding_boxes = [ClientSideBoundingBoxes.get_bounding_box(vehicle, camera) for vehicle in vehicles]
+            return [bb for bb in bounding_boxes if all(bb[:, 2] > 0)]
+
+        def batched():
+            return ClientSideBoundingBoxes.project_bounding_boxes(vehicles, camera, frustum=False)
+
+        cache = BoundingBoxCache()
+
+        def cached():
+            cache.retain(vehicles)
+            return ClientSideBoundingBoxes.project_bounding_boxes(vehicles, camera, cache=cache, frustum=False)
+
+        def culled():
+            cache.retain(vehicles)
+            return ClientSideBoundingBoxes.project_bounding_boxes(vehicles, camera, args.max_distance, cache=cache)
+
+        # Without culling the batched path keeps the same boxes as the per-vehicle one
+        bounding_boxes, indices = batched()
+        reference = np.array([ClientSideBoundingBoxes.get_bounding_box(vehicles[i], camera) for i in indices])
+        difference = np.abs(reference.reshape(-1, 8, 3) - bounding_boxes).max() if len(indices) else 0.0
+        stats = {}
+        ClientSideBoundingBoxes.project_bounding_boxes(vehicles, camera, args.max_distance, stats)
+
+        timings = []
+        for project in (per_vehicle, batched, cached, culled):
+            start = time.perf_counter()
+            for _ in range(args.benchmark_frames):
+                project()
+            timings.append(1000.0 * (time.perf_counter() - start) / args.benchmark_frames)
+        print('%5d actors  per-vehicle %8.3f ms  batched %8.3f ms  cached %8.3f ms  culled %8.3f ms  max difference %.2e' % (
+            num_vehicles, timings[0], timings[1], timings[2], timings[3], difference))
+        print('             batched vs per-vehicle %6.1fx  cache %6.2fx  culling %6.2fx' % (
+            timings[0] / timings[1], timings[1] / timings[2], timings[2] / timings[3]))
+        print('             %s' % format_cull_stats(stats))
+
+
+def generate_synthetic_boxes(num_boxes, rng):
+    """
+    Returns (N, 8, 3) projected boxes of random size spread over the image.
+    """
+
+    # Corners of a box seen from the front left, in pixels around its center
+    template = np.array([[30, 20], [-20, 15], [-30, 25], [20, 30],
+                         [30, -20], [-20, -15], [-30, -5], [20, 0]], dtype=np.float64)
+    boxes = np.empty((num_boxes, 8, 3))
+    centers = rng.uniform([0, 0], [VIEW_WIDTH, VIEW_HEIGHT], (num_boxes, 1, 2))
+    boxes[:, :, :2] = centers + template * rng.uniform(0.5, 3.0, (num_boxes, 1, 1))
+    boxes[:, :, 2] = rng.uniform(5.0, 100.0, (num_boxes, 1))
+    return boxes
+
+
+def benchmark_draw(args):
+    """
+    Times drawing with draw_bounding_boxes and BoundingBoxRenderer, headless
+    with the SDL dummy video driver unless SDL_VIDEODRIVER is set.
+    """
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    pygame.init()
+    try:
+        display = pygame.display.set_mode((VIEW_WIDTH, VIEW_HEIGHT))
+        overlay = BoundingBoxRenderer(overlay=True)
+        direct = BoundingBoxRenderer(overlay=False)
+        rng = np.random.default_rng(0)
+        for num_boxes in [int(n) for n in args.benchmark_actors.split(',')]:
+            bounding_boxes = generate_synthetic_boxes(num_boxes, rng)
+            timings = []
+            for draw in (ClientSideBoundingBoxes.draw_bounding_boxes, overlay.draw, direct.draw):
+                start = time.perf_counter()
+                for _ in range(args.benchmark_frames):
+                    draw(display, bounding_boxes)
+                timings.append(1000.0 * (time.perf_counter() - start) / args.benchmark_frames)
+            print('%5d boxes  per-edge %8.3f ms  overlay %8.3f ms  direct %8.3f ms  speedup %6.1fx' % (
+                num_boxes, timings[0], timings[1], timings[2], timings[0] / timings[2]))
+    finally:
+        pygame.quit()
+
+
+def format_cull_stats(stats):
+    """
+    Returns a one line summary of the stats filled by get_bounding_boxes.
+    """
+
+    return ', '.join('%s %d' % (key.replace('_', ' '), stats.get(key, 0)) for key in (
+        'vehicles', 'distance_culled', 'frustum_culled', 'behind_camera', 'outside_image', 'projected', 'occluded'))
+
+
 # ==============================================================================
 # -- main() --------------------------------------------------------------------
 # ==============================================================================
@@ -423,8 +981,76 @@ def main():
     Initializes the client-side bounding box demo.
     """
 
+    argparser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument(
+        '--benchmark',
+        action='store_true',
+        help='time the bounding box projection on synthetic vehicles, no simulator needed')
+    argparser.add_argument(
+        '--benchmark-draw',
+        action='store_true',
+        help='time drawing synthetic boxes with the SDL dummy video driver, no simulator or window needed')
+    argparser.add_argument(
+        '--benchmark-actors',
+        metavar='N,N,...',
+        default='10,100,1000',
+        help='vehicle or box counts of the benchmarks (default: 10,100,1000)')
+    argparser.add_argument(
+        '--benchmark-frames',
+        default=100,
+        type=int,
+        help='frames per vehicle count in the benchmarks (default: 100)')
+    argparser.add_argument(
+        '--max-distance',
+        default=0.0,
+        type=float,
+        help='do not draw vehicles farther away from the camera in meters, 0 draws all (default: 0)')
+    argparser.add_argument(
+        '--render-mode',
+        choices=['direct', 'overlay', 'per-edge'],
+        default='direct',
+        help='draw every box as one polyline straight onto the camera image or onto a persistent overlay,'
+        ' or with 12 lines on a new overlay per frame (default: direct)')
+    argparser.add_argument(
+        '--annotations',
+        metavar='DIR',
+        default=None,
+        help='export the camera images and projected boxes of every frame to DIR')
+    argparser.add_argument(
+        '--annotation-shard-frames',
+        default=1000,
+        type=int,
+        help='frames per annotations_NNNNN.jsonl shard (default: 1000)')
+    argparser.add_argument(
+        '--occlusion',
+        action='store_true',
+        help='attach a depth camera and drop the boxes of vehicles hidden behind other objects')
+    argparser.add_argument(
+        '--min-visible',
+        default=0.2,
+        type=float,
+        help='visible fraction a box needs with --occlusion (default: 0.2)')
+    argparser.add_argument(
+        '--occlusion-tolerance',
+        default=1.0,
+        type=float,
+        help='depth in meters an occluder has to be in front of a vehicle (default: 1.0)')
+    args = argparser.parse_args()
+    # Checked before connecting, AnnotationWriter refuses the directory as well
+    if args.annotations and AnnotationWriter.has_dataset(args.annotations):
+        argparser.error('--annotations %s already holds an annotation dataset' % args.annotations)
+
+    if args.benchmark:
+        benchmark(args)
+        return
+    if args.benchmark_draw:
+        benchmark_draw(args)
+        return
+
     try:
-        client = BasicSynchronousClient()
+        client = BasicSynchronousClient(args)
         client.game_loop()
     finally:
         print('EXIT')
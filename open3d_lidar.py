@@ -12,7 +12,10 @@ import glob
 import os
 import sys
 import argparse
+import json
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import random
 import numpy as np
@@ -56,28 +59,231 @@ LABEL_COLORS = np.array([
     (45, 60, 150),   # Water
     (145, 170, 100), # Terrain
 ]) / 255.0 # normalize each channel [0-1] since is what Open3D uses
+LABEL_COLORS_F32 = LABEL_COLORS.astype(np.float32)
+LABEL_NAMES = [
+    'None', 'Building', 'Fences', 'Other', 'Pedestrian', 'Pole', 'RoadLines',
+    'Road', 'Sidewalk', 'Vegetation', 'Vehicle', 'Wall', 'TrafficSign', 'Sky',
+    'Ground', 'Bridge', 'RailTrack', 'GuardRail', 'TrafficLight', 'Static',
+    'Dynamic', 'Water', 'Terrain']
 
+# Number of quantization steps of the lidar intensity in the color lookup table
+INTENSITY_LUT_SIZE = 4096
 
-def lidar_callback(point_cloud, point_list):
-    """Prepares a point cloud with intensity
-    colors ready to be consumed by Open3D"""
-    data = np.copy(np.frombuffer(point_cloud.raw_data, dtype=np.dtype('f4')))
-    data = np.reshape(data, (int(data.shape[0] / 4), 4))
 
-    # Isolate the intensity and compute a color for it
-    intensity = data[:, -1]
-    intensity_col = 1.0 - np.log(intensity) / np.log(np.exp(-0.004 * 100))
-    int_color = np.c_[
+def build_intensity_lut(size=INTENSITY_LUT_SIZE):
+    """Precomputes the color of every quantized intensity in [0, 1]
+    with the same log mapping onto VIRIDIS as the original callback"""
+    intensity = np.linspace(0.0, 1.0, size)
+    # log(0) is -inf, which np.interp clamps to the first color
+    with np.errstate(divide='ignore'):
+        intensity_col = 1.0 - np.log(intensity) / np.log(np.exp(-0.004 * 100))
+    lut = np.c_[
         np.interp(intensity_col, VID_RANGE, VIRIDIS[:, 0]),
         np.interp(intensity_col, VID_RANGE, VIRIDIS[:, 1]),
         np.interp(intensity_col, VID_RANGE, VIRIDIS[:, 2])]
+    return np.ascontiguousarray(lut, dtype=np.float32)
 
-    # Isolate the 3D data
-    points = data[:, :-1]
+
+INTENSITY_LUT = build_intensity_lut()
+
+
+class PointCloudBuffer(object):
+    """Preallocated float32 points and colors that are reused across frames,
+    they only grow when a scan has more points than any scan before"""
+
+    def __init__(self, capacity=0):
+        self.size = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self._points = np.empty((capacity, 3), dtype=np.float32)
+        self._colors = np.empty((capacity, 3), dtype=np.float32)
+        self._scratch = np.empty(capacity, dtype=np.float32)
+        self._index = np.empty(capacity, dtype=np.intp)
+
+    def resize(self, size):
+        if size > self.capacity:
+            self._allocate(max(size, int(self.capacity * 1.5)))
+        self.size = size
+
+    @property
+    def points(self):
+        return self._points[:self.size]
+
+    @property
+    def colors(self):
+        return self._colors[:self.size]
+
+
+def decode_lidar(raw_data, buffer):
+    """Decodes a raw lidar measurement into the points and
+    intensity colors of buffer without copying raw_data first"""
+    # Read-only view into the measurement, every output is written into the buffer
+    data = np.frombuffer(raw_data, dtype=np.dtype('f4')).reshape(-1, 4)
+    buffer.resize(data.shape[0])
+    points = buffer.points
+    colors = buffer.colors
 
     # We're negating the y to correclty visualize a world that matches
     # what we see in Unreal since Open3D uses a right-handed coordinate system
-    points[:, :1] = -points[:, :1]
+    np.copyto(points, data[:, :3])
+    np.negative(points[:, 0], out=points[:, 0])
+
+    # Quantize the intensity and look its color up in a single gather
+    scratch = buffer._scratch[:buffer.size]
+    index = buffer._index[:buffer.size]
+    np.multiply(data[:, 3], INTENSITY_LUT_SIZE - 1, out=scratch)
+    np.add(scratch, 0.5, out=scratch)
+    np.clip(scratch, 0, INTENSITY_LUT_SIZE - 1, out=scratch)
+    np.copyto(index, scratch, casting='unsafe')
+    np.take(INTENSITY_LUT, index, axis=0, out=colors, mode='clip')
+    return points, colors
+
+
+class PointCloudFilter(object):
+    """Optional preprocessing between the decoding and the visualizer: range
+    and ROI crop, ground removal, voxel grid downsampling and a cap on the
+    number of points. Works on the decoded points, that is in the
+    coordinates shown by Open3D. Counts the points in and out of every stage"""
+
+    def __init__(self, max_range=None, roi=None, ground_height=None, voxel_size=None, max_points=None):
+        self.max_range = max_range
+        # roi: xmin, xmax, ymin, ymax, zmin, zmax
+        self.roi = np.asarray(roi, dtype=np.float32).reshape(3, 2) if roi is not None else None
+        self.ground_height = ground_height
+        self.voxel_size = voxel_size
+        self.max_points = max_points
+        self.stages = [name for name, option in (
+            ('range', max_range), ('roi', roi), ('ground', ground_height),
+            ('voxel', voxel_size), ('max_points', max_points)) if option is not None]
+        # Points in and out of every stage, summed over all scans
+        self.points_in = {stage: 0 for stage in self.stages}
+        self.points_out = {stage: 0 for stage in self.stages}
+        self.scans = 0
+        self.last_in = 0
+        self.last_out = 0
+        # The callback decodes into this buffer, the filtered points go to the handoff
+        self.input_buffer = PointCloudBuffer()
+
+    @property
+    def enabled(self):
+        return len(self.stages) > 0
+
+    def _count(self, stage, count_in, count_out):
+        self.points_in[stage] += count_in
+        self.points_out[stage] += count_out
+
+    def apply(self, points, colors, out_buffer):
+        """Writes the points and colors that pass every stage into out_buffer"""
+        self.last_in = points.shape[0]
+        keep = np.ones(points.shape[0], dtype=bool)
+
+        # The crops only combine masks, the points are gathered once afterwards
+        if self.max_range is not None:
+            count = np.count_nonzero(keep)
+            keep &= np.einsum('ij,ij->i', points, points) <= self.max_range * self.max_range
+            self._count('range', count, np.count_nonzero(keep))
+        if self.roi is not None:
+            count = np.count_nonzero(keep)
+            keep &= np.all((points >= self.roi[:, 0]) & (points <= self.roi[:, 1]), axis=1)
+            self._count('roi', count, np.count_nonzero(keep))
+        if self.ground_height is not None:
+            count = np.count_nonzero(keep)
+            keep &= points[:, 2] > self.ground_height
+            self._count('ground', count, np.count_nonzero(keep))
+        index = np.flatnonzero(keep)
+
+        if self.voxel_size is not None and index.size > 0:
+            # Keep the first point of every occupied voxel
+            voxels = np.floor(points[index] / self.voxel_size).astype(np.int64)
+            voxels -= voxels.min(axis=0)
+            keys = np.ravel_multi_index(voxels.T, voxels.max(axis=0) + 1)
+            _, first = np.unique(keys, return_index=True)
+            self._count('voxel', index.size, first.size)
+            index = index[np.sort(first)]
+        elif self.voxel_size is not None:
+            self._count('voxel', 0, 0)
+
+        if self.max_points is not None:
+            count = index.size
+            if count > self.max_points:
+                # Evenly strided subset, which keeps the scan pattern intact
+                index = index[np.linspace(0, count - 1, self.max_points).astype(np.intp)]
+            self._count('max_points', count, index.size)
+
+        out_buffer.resize(index.size)
+        np.take(points, index, axis=0, out=out_buffer.points)
+        np.take(colors, index, axis=0, out=out_buffer.colors)
+        self.scans += 1
+        self.last_out = index.size
+        return out_buffer.points, out_buffer.colors
+
+    def summary(self):
+        """Average points in and out of every stage per scan"""
+        scans = max(self.scans, 1)
+        return ', '.join('%s: %d -> %d' % (stage, self.points_in[stage] // scans, self.points_out[stage] // scans)
+                         for stage in self.stages)
+
+
+class PointCloudHandoff(object):
+    """Triple buffer that hands decoded scans from the sensor callback
+    thread to the render loop. The callback fills the back buffer and
+    publishes it, the render loop takes the newest published scan. Each
+    side only ever touches its own buffer, so no frame is torn"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._back = PointCloudBuffer()
+        self._ready = PointCloudBuffer()
+        self._front = PointCloudBuffer()
+        self._ready_frame = None
+        self._new = False
+        self.frame = None
+        self.published = 0
+        self.consumed = 0
+        # Scans overwritten before the render loop took them
+        self.dropped = 0
+        # Render loop iterations without a new scan
+        self.duplicated = 0
+
+    def back_buffer(self):
+        """Buffer the producer writes the next scan into"""
+        return self._back
+
+    def publish(self, frame):
+        """Makes the back buffer the newest scan"""
+        with self._lock:
+            self._back, self._ready = self._ready, self._back
+            if self._new:
+                self.dropped += 1
+            self._new = True
+            self._ready_frame = frame
+            self.published += 1
+
+    def acquire(self):
+        """Returns the buffer with the newest scan, or None if no scan
+        arrived since the last call. The buffer stays valid until the
+        next call"""
+        with self._lock:
+            if not self._new:
+                self.duplicated += 1
+                return None
+            self._front, self._ready = self._ready, self._front
+            self._new = False
+            self.frame = self._ready_frame
+            self.consumed += 1
+        return self._front
+
+
+def lidar_callback(point_cloud, handoff, point_filter=None):
+    """Prepares a point cloud with intensity
+    colors ready to be consumed by Open3D"""
+    if point_filter is not None and point_filter.enabled:
+        points, colors = decode_lidar(point_cloud.raw_data, point_filter.input_buffer)
+        point_filter.apply(points, colors, handoff.back_buffer())
+    else:
+        decode_lidar(point_cloud.raw_data, handoff.back_buffer())
 
     # # An example of converting points from sensor to vehicle space if we had
     # # a carla.Transform variable named "tran":
@@ -85,34 +291,67 @@ def lidar_callback(point_cloud, point_list):
     # points = np.dot(tran.get_matrix(), points.T).T
     # points = points[:, :-1]
 
-    point_list.points = o3d.utility.Vector3dVector(points)
-    point_list.colors = o3d.utility.Vector3dVector(int_color)
+    handoff.publish(point_cloud.frame)
 
 
-def semantic_lidar_callback(point_cloud, point_list):
-    """Prepares a point cloud with semantic segmentation
-    colors ready to be consumed by Open3D"""
-    data = np.frombuffer(point_cloud.raw_data, dtype=np.dtype([
-        ('x', np.float32), ('y', np.float32), ('z', np.float32),
-        ('CosAngle', np.float32), ('ObjIdx', np.uint32), ('ObjTag', np.uint32)]))
+class LabelHistogram(object):
+    """Number of semantic lidar points per class, summed over all scans"""
+
+    def __init__(self):
+        self.counts = np.zeros(len(LABEL_NAMES), dtype=np.int64)
+        self.scans = 0
+
+    def add(self, tags):
+        # Tags without a known class are ignored
+        self.counts += np.bincount(tags, minlength=len(LABEL_NAMES))[:len(LABEL_NAMES)]
+        self.scans += 1
+
+    def summary(self):
+        total = max(int(self.counts.sum()), 1)
+        return '\n'.join('%-12s %12d %6.2f%%' % (name, count, 100.0 * count / total)
+                         for name, count in zip(LABEL_NAMES, self.counts) if count > 0)
+
+
+def decode_semantic_lidar(raw_data, buffer, histogram=None):
+    """Decodes a raw semantic lidar measurement into the points and
+    label colors of buffer in a single pass over raw_data"""
+    # Every point is x, y, z, CosAngle (f4), ObjIdx, ObjTag (u4). Two strided
+    # views of the same memory avoid copying the structured fields
+    fields = np.frombuffer(raw_data, dtype=np.dtype('f4')).reshape(-1, 6)
+    tags = np.frombuffer(raw_data, dtype=np.dtype('u4')).reshape(-1, 6)[:, 5]
+    buffer.resize(fields.shape[0])
+    points = buffer.points
+    colors = buffer.colors
 
     # We're negating the y to correclty visualize a world that matches
     # what we see in Unreal since Open3D uses a right-handed coordinate system
-    points = np.array([data['x'], -data['y'], data['z']]).T
+    np.copyto(points, fields[:, :3])
+    np.negative(points[:, 1], out=points[:, 1])
 
     # # An example of adding some noise to our data if needed:
     # points += np.random.uniform(-0.05, 0.05, size=points.shape)
 
     # Colorize the pointcloud based on the CityScapes color palette
-    labels = np.array(data['ObjTag'])
-    int_color = LABEL_COLORS[labels]
+    np.take(LABEL_COLORS_F32, tags, axis=0, out=colors, mode='clip')
 
     # # In case you want to make the color intensity depending
     # # of the incident ray angle, you can use:
-    # int_color *= np.array(data['CosAngle'])[:, None]
+    # colors *= fields[:, 3:4]
 
-    point_list.points = o3d.utility.Vector3dVector(points)
-    point_list.colors = o3d.utility.Vector3dVector(int_color)
+    if histogram is not None:
+        histogram.add(tags)
+    return points, colors
+
+
+def semantic_lidar_callback(point_cloud, handoff, point_filter=None, histogram=None):
+    """Prepares a point cloud with semantic segmentation
+    colors ready to be consumed by Open3D"""
+    if point_filter is not None and point_filter.enabled:
+        points, colors = decode_semantic_lidar(point_cloud.raw_data, point_filter.input_buffer, histogram)
+        point_filter.apply(points, colors, handoff.back_buffer())
+    else:
+        decode_semantic_lidar(point_cloud.raw_data, handoff.back_buffer(), histogram)
+    handoff.publish(point_cloud.frame)
 
 
 def generate_lidar_bp(arg, world, blueprint_library, delta):
@@ -156,11 +395,476 @@ def add_open3d_axis(vis):
     vis.add_geometry(axis)
 
 
+class SyntheticLidarMeasurement(object):
+    """Stand-in for carla.LidarMeasurement with a raw_data buffer of x, y, z, intensity"""
+
+    def __init__(self, raw_data, frame):
+        self.raw_data = raw_data
+        self.frame = frame
+
+
+def generate_synthetic_scan(channels, points_per_frame, upper_fov, lower_fov, max_range, rng):
+    """Creates a random scan that looks like a CARLA lidar measurement"""
+    points_per_channel = max(int(points_per_frame // channels), 1)
+    azimuth = rng.uniform(0.0, 2.0 * np.pi, (channels, points_per_channel))
+    elevation = np.radians(np.linspace(lower_fov, upper_fov, channels))[:, None]
+    distance = rng.uniform(1.0, max_range, (channels, points_per_channel))
+    data = np.empty((channels * points_per_channel, 4), dtype=np.float32)
+    data[:, 0] = (distance * np.cos(elevation) * np.cos(azimuth)).ravel()
+    data[:, 1] = (distance * np.cos(elevation) * np.sin(azimuth)).ravel()
+    data[:, 2] = (distance * np.sin(elevation)).ravel()
+    # CARLA attenuates the intensity with exp(-0.004 * distance)
+    data[:, 3] = np.exp(-0.004 * distance).ravel()
+    return data.tobytes()
+
+
+def reference_lidar_decode(raw_data):
+    """The original per-frame decoding of lidar_callback, kept for the benchmark"""
+    data = np.copy(np.frombuffer(raw_data, dtype=np.dtype('f4')))
+    data = np.reshape(data, (int(data.shape[0] / 4), 4))
+    intensity = data[:, -1]
+    intensity_col = 1.0 - np.log(intensity) / np.log(np.exp(-0.004 * 100))
+    int_color = np.c_[
+        np.interp(intensity_col, VID_RANGE, VIRIDIS[:, 0]),
+        np.interp(intensity_col, VID_RANGE, VIRIDIS[:, 1]),
+        np.interp(intensity_col, VID_RANGE, VIRIDIS[:, 2])]
+    points = data[:, :-1]
+    points[:, :1] = -points[:, :1]
+    return points, int_color
+
+
+def benchmark(arg):
+    """Measures the decoding throughput of the lidar callback on synthetic scans"""
+    rng = np.random.default_rng(0)
+    points_per_frame = int(arg.points_per_second * arg.delta)
+    scans = [SyntheticLidarMeasurement(generate_synthetic_scan(
+        int(arg.channels), points_per_frame, arg.upper_fov, arg.lower_fov, arg.range, rng), frame)
+        for frame in range(8)]
+    num_points = sum(len(scan.raw_data) // 16 for scan in scans)
+
+    buffer = PointCloudBuffer()
+    reference_points, reference_colors = reference_lidar_decode(scans[0].raw_data)
+    points, colors = decode_lidar(scans[0].raw_data, buffer)
+    print('Max color difference to the reference: %.5f' % np.abs(reference_colors - colors).max())
+    print('Max point difference to the reference: %.5f' % np.abs(reference_points - points).max())
+
+    for name, decode in (('reference', reference_lidar_decode),
+                         ('lookup table', lambda raw_data: decode_lidar(raw_data, buffer))):
+        start = time.perf_counter()
+        for _ in range(arg.benchmark_frames // len(scans)):
+            for scan in scans:
+                decode(scan.raw_data)
+        elapsed = time.perf_counter() - start
+        total_points = num_points * (arg.benchmark_frames // len(scans))
+        print('%-12s %8.2f Mpoints/s  %6.2f ms/frame' % (
+            name, total_points / elapsed / 1e6, 1000.0 * elapsed / (arg.benchmark_frames // len(scans) * len(scans))))
+
+
+class ScanRecorder(object):
+    """Records lidar scans into a directory of append-only segments. Each
+    segment_NNNNN.npy (or .npz with compression) holds the concatenated raw
+    bytes of up to scans_per_segment scans, raw f4 x, y, z, intensity or
+    the semantic structured points. index.jsonl gets one line per scan with
+    its frame, timestamp, transform and byte range in the segment. The
+    transform is the sensor pose, or the vehicle pose for fused clouds in
+    the vehicle frame, meta.json tells which with 'frame'.
+    Segments are written by a background thread, the sensor thread only
+    copies the raw data. A directory holds a single recording, one that
+    already has an index is refused instead of being overwritten"""
+
+    def __init__(self, directory, semantic=False, scans_per_segment=100, compress=False, frame='sensor'):
+        if os.path.exists(os.path.join(directory, 'index.jsonl')):
+            raise ValueError('%s already holds a recording, record into a new directory' % directory)
+        self.directory = directory
+        self.scans_per_segment = scans_per_segment
+        self.compress = compress
+        self.segment = 0
+        self.recorded = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump({'version': 1, 'semantic': semantic, 'frame': frame}, f, indent=2)
+        self._index = open(os.path.join(directory, 'index.jsonl'), 'a')
+
+    def record(self, point_cloud):
+        """Copies a carla.LidarMeasurement or SemanticLidarMeasurement"""
+        transform = point_cloud.transform
+        entry = {
+            'frame': point_cloud.frame,
+            'timestamp': point_cloud.timestamp,
+            'transform': [transform.location.x, transform.location.y, transform.location.z,
+                          transform.rotation.pitch, transform.rotation.yaw, transform.rotation.roll]}
+        raw_data = bytes(point_cloud.raw_data)
+        with self._lock:
+            self._pending.append((entry, raw_data))
+            if len(self._pending) >= self.scans_per_segment:
+                self._submit()
+
+    def _submit(self):
+        pending, self._pending = self._pending, []
+        self._executor.submit(self._write_segment, self.segment, pending)
+        self.segment += 1
+
+    def _write_segment(self, segment, pending):
+        data = np.frombuffer(b''.join(raw_data for _, raw_data in pending), dtype=np.uint8)
+        name = 'segment_%05d.%s' % (segment, 'npz' if self.compress else 'npy')
+        path = os.path.join(self.directory, name)
+        # The segment is complete on disk before the index refers to it
+        with open(path + '.tmp', 'wb') as f:
+            if self.compress:
+                np.savez_compressed(f, scans=data)
+            else:
+                np.save(f, data)
+        os.replace(path + '.tmp', path)
+
+        offset = 0
+        for entry, raw_data in pending:
+            entry['segment'] = name
+            entry['offset'] = offset
+            entry['size'] = len(raw_data)
+            offset += len(raw_data)
+            self._index.write(json.dumps(entry) + '\n')
+        self._index.flush()
+        self.recorded += len(pending)
+
+    def close(self):
+        with self._lock:
+            if self._pending:
+                self._submit()
+        self._executor.shutdown(wait=True)
+        self._index.close()
+
+
+class RecordedScan(object):
+    """A recorded scan with the attributes of a carla lidar measurement
+    that are used by the callbacks"""
+
+    def __init__(self, raw_data, frame, timestamp, transform):
+        self.raw_data = raw_data
+        self.frame = frame
+        self.timestamp = timestamp
+        self.transform = transform
+
+
+class ScanReplayer(object):
+    """Streams a directory written by ScanRecorder back through the lidar
+    callbacks from its own thread, at the recorded speed times speed or as
+    fast as possible with speed 0. Uncompressed segments are memory mapped"""
+
+    def __init__(self, directory, speed=1.0):
+        self.directory = directory
+        self.speed = speed
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(directory, 'index.jsonl'), 'r') as f:
+            self.index = [json.loads(line) for line in f if line.strip()]
+        self.fps = 0.0
+        self.replayed = 0
+        self._segments = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def semantic(self):
+        return self.meta['semantic']
+
+    def _segment(self, name):
+        if name not in self._segments:
+            path = os.path.join(self.directory, name)
+            if name.endswith('.npz'):
+                # Compressed segments are decompressed into memory, only the current one is kept
+                with np.load(path) as archive:
+                    self._segments = {name: archive['scans']}
+            else:
+                self._segments[name] = np.load(path, mmap_mode='r')
+        return self._segments[name]
+
+    def scans(self):
+        """Yields the recorded scans in order"""
+        for entry in self.index:
+            segment = self._segment(entry['segment'])
+            raw_data = segment[entry['offset']:entry['offset'] + entry['size']]
+            x, y, z, pitch, yaw, roll = entry['transform']
+            transform = carla.Transform(carla.Location(x=x, y=y, z=z), carla.Rotation(pitch=pitch, yaw=yaw, roll=roll))
+            yield RecordedScan(raw_data, entry['frame'], entry['timestamp'], transform)
+
+    def start(self, callback):
+        self._thread = threading.Thread(target=self._run, args=(callback,), name='scan-replayer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, callback):
+        start_time = time.perf_counter()
+        last_time = start_time
+        first_timestamp = None
+        for scan in self.scans():
+            if self._stop_event.is_set():
+                return
+            if first_timestamp is None:
+                first_timestamp = scan.timestamp
+            if self.speed > 0:
+                remaining = start_time + (scan.timestamp - first_timestamp) / self.speed - time.perf_counter()
+                if remaining > 0:
+                    self._stop_event.wait(remaining)
+            callback(scan)
+            now = time.perf_counter()
+            self.fps = 1.0 / max(now - last_time, 1e-9)
+            last_time = now
+            self.replayed += 1
+
+
+def replay(arg):
+    """Shows a recorded lidar sequence without a simulator"""
+    replayer = ScanReplayer(arg.replay, speed=arg.replay_speed)
+    point_list = o3d.geometry.PointCloud()
+    handoff = PointCloudHandoff()
+    point_filter = create_point_filter(arg)
+    histogram = None
+    if replayer.semantic:
+        histogram = LabelHistogram()
+        callback = lambda data: semantic_lidar_callback(data, handoff, point_filter, histogram)
+    else:
+        callback = lambda data: lidar_callback(data, handoff, point_filter)
+
+    vis = create_visualizer(arg)
+    try:
+        replayer.start(callback)
+        render_loop(vis, point_list, handoff, arg, ticker=replayer, point_filter=point_filter)
+    finally:
+        replayer.stop()
+        print('\nReplayed %d of %d scans' % (replayer.replayed, len(replayer.index)))
+        if point_filter.enabled:
+            print('Average points per scan: ' + point_filter.summary())
+        if histogram is not None and histogram.scans > 0:
+            print('Semantic lidar points per class over %d scans:' % histogram.scans)
+            print(histogram.summary())
+        vis.destroy_window()
+
+
+def parse_lidar_mounts(arg):
+    """Returns the sensor to vehicle transform of every lidar. --lidar-mounts
+    is a ';' separated list of x,y,z[,yaw[,pitch[,roll]]], the -x -y -z
+    offset is added to every mount"""
+    user_offset = carla.Location(arg.x, arg.y, arg.z)
+    if not arg.lidar_mounts:
+        return [carla.Transform(carla.Location(x=-0.5, z=1.8) + user_offset)]
+    transforms = []
+    for mount in arg.lidar_mounts.split(';'):
+        values = [float(v) for v in mount.split(',')] + [0.0] * 3
+        x, y, z, yaw, pitch, roll = values[:6]
+        transforms.append(carla.Transform(
+            carla.Location(x=x, y=y, z=z) + user_offset,
+            carla.Rotation(pitch=pitch, yaw=yaw, roll=roll)))
+    return transforms
+
+
+def matrix_to_transform(matrix):
+    """Inverse of carla.Transform.get_matrix for a 4x4 rigid transform"""
+    pitch = np.degrees(np.arcsin(np.clip(matrix[2, 0], -1.0, 1.0)))
+    yaw = np.degrees(np.arctan2(matrix[1, 0], matrix[0, 0]))
+    roll = np.degrees(np.arctan2(-matrix[2, 1], matrix[2, 2]))
+    return carla.Transform(
+        carla.Location(x=float(matrix[0, 3]), y=float(matrix[1, 3]), z=float(matrix[2, 3])),
+        carla.Rotation(pitch=float(pitch), yaw=float(yaw), roll=float(roll)))
+
+
+class LidarFusion(object):
+    """Fuses the scans of several lidars into one cloud in the vehicle frame.
+    Scans are matched by their frame number, a frame is fused as soon as every
+    lidar delivered it and older incomplete frames are dropped. All sensor to
+    vehicle transforms are applied in a single batched matmul. The fused scan
+    carries the world pose of the vehicle at its frame, the frame its points
+    are in, derived from the pose of the first lidar and its mount"""
+
+    def __init__(self, sensor_transforms, semantic=False, callback=None):
+        matrices = np.array([transform.get_matrix() for transform in sensor_transforms], dtype=np.float32)
+        self.vehicle_from_first = np.linalg.inv(np.array(sensor_transforms[0].get_matrix(), dtype=np.float64))
+        # Row vector form: points @ rotation^T + translation
+        self.rotations = np.ascontiguousarray(matrices[:, :3, :3].transpose(0, 2, 1))
+        self.translations = matrices[:, None, :3, 3]
+        self.num_sensors = len(sensor_transforms)
+        # Values per point, x, y, z, intensity or the semantic fields
+        self.row_size = 6 if semantic else 4
+        self.callback = callback
+        self.fused = 0
+        self.dropped = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Two sensor threads can complete a frame at the same time, the
+        # callback decodes into shared buffers so only one may run at once
+        self._fuse_lock = threading.Lock()
+
+    def add(self, sensor_index, point_cloud):
+        """Called from the sensor callback of lidar sensor_index"""
+        frame = point_cloud.frame
+        with self._lock:
+            scans = self._pending.setdefault(frame, [None] * self.num_sensors)
+            scans[sensor_index] = point_cloud
+            if any(scan is None for scan in scans):
+                return
+            del self._pending[frame]
+            for old_frame in [f for f in self._pending if f < frame]:
+                del self._pending[old_frame]
+                self.dropped += 1
+        with self._fuse_lock:
+            fused = self.fuse(scans)
+            self.fused += 1
+            if self.callback is not None:
+                self.callback(fused)
+
+    def fuse(self, scans):
+        """Returns a scan with the raw data of all scans in the vehicle frame"""
+        raw_data = b''.join(bytes(scan.raw_data) for scan in scans)
+        rows = np.frombuffer(raw_data, dtype=np.dtype('f4')).reshape(-1, self.row_size).copy()
+        counts = np.array([len(scan.raw_data) // (4 * self.row_size) for scan in scans])
+
+        # Scatter the points into a (sensors, max points, 3) batch, transform
+        # all of them at once and gather them back
+        sensor_ids = np.repeat(np.arange(self.num_sensors), counts)
+        positions = np.arange(rows.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+        batch = np.zeros((self.num_sensors, counts.max(), 3), dtype=np.float32)
+        batch[sensor_ids, positions] = rows[:, :3]
+        batch = np.matmul(batch, self.rotations) + self.translations
+        rows[:, :3] = batch[sensor_ids, positions]
+
+        # vehicle to world = first sensor to world * vehicle to first sensor
+        first = scans[0]
+        vehicle_matrix = np.dot(np.array(first.transform.get_matrix(), dtype=np.float64), self.vehicle_from_first)
+        return RecordedScan(rows, first.frame, first.timestamp, matrix_to_transform(vehicle_matrix))
+
+
+class SimulationTicker(object):
+    """Ticks the synchronous simulator from a dedicated thread at a fixed
+    wall clock rate, independent of the render loop"""
+
+    def __init__(self, world, tick_rate):
+        self.world = world
+        # A tick rate of 0 ticks as fast as the simulator allows
+        self.period = 1.0 / tick_rate if tick_rate > 0 else 0.0
+        self.fps = 0.0
+        self.ticks = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='simulation-ticker', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        next_time = time.perf_counter()
+        last_time = next_time
+        while not self._stop_event.is_set():
+            self.world.tick()
+            now = time.perf_counter()
+            self.fps = 1.0 / max(now - last_time, 1e-9)
+            last_time = now
+            self.ticks += 1
+            if self.period > 0:
+                next_time += self.period
+                remaining = next_time - time.perf_counter()
+                if remaining > 0:
+                    self._stop_event.wait(remaining)
+                else:
+                    # Running behind, do not try to catch up with a burst of ticks
+                    next_time = time.perf_counter()
+
+
+def create_visualizer(arg):
+    """Opens the Open3D window"""
+    vis = o3d.visualization.Visualizer()
+    vis.create_window(
+        window_name='Carla Lidar',
+        width=960,
+        height=540,
+        left=480,
+        top=270)
+    vis.get_render_option().background_color = [0.05, 0.05, 0.05]
+    vis.get_render_option().point_size = 1
+    vis.get_render_option().show_coordinate_frame = True
+
+    if arg.show_axis:
+        add_open3d_axis(vis)
+    return vis
+
+
+def create_point_filter(arg):
+    """Creates the preprocessing stage configured on the command line"""
+    return PointCloudFilter(
+        max_range=arg.crop_range,
+        roi=arg.roi,
+        ground_height=arg.remove_ground,
+        voxel_size=arg.voxel_size,
+        max_points=arg.max_points)
+
+
+def render_loop(vis, point_list, handoff, arg, tick=None, ticker=None, point_filter=None):
+    """Draws the newest scan of handoff until the window is closed. With
+    tick the simulation is advanced once per frame, in lockstep with the
+    renderer. With ticker the simulation runs on its own thread and the
+    render rate is capped by --render-fps"""
+    frame_period = 1.0 / arg.render_fps if arg.render_fps > 0 else 0.0
+    geometry_added = False
+    dt0 = datetime.now()
+    next_frame = time.perf_counter()
+    while True:
+        # Only upload to the GPU when a new scan arrived
+        cloud = handoff.acquire()
+        if cloud is not None:
+            point_list.points = o3d.utility.Vector3dVector(cloud.points)
+            point_list.colors = o3d.utility.Vector3dVector(cloud.colors)
+            if not geometry_added:
+                vis.add_geometry(point_list)
+                geometry_added = True
+            else:
+                vis.update_geometry(point_list)
+
+        if not vis.poll_events():
+            return
+        vis.update_renderer()
+        if tick is not None:
+            # # This can fix Open3D jittering issues:
+            time.sleep(0.005)
+            tick()
+        if frame_period > 0:
+            next_frame += frame_period
+            remaining = next_frame - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+            else:
+                next_frame = time.perf_counter()
+
+        process_time = datetime.now() - dt0
+        render_fps = 1.0 / max(process_time.total_seconds(), 1e-9)
+        sim_fps = ticker.fps if ticker is not None else render_fps
+        status = '\r' + 'Sim FPS: %.1f Render FPS: %.1f' % (sim_fps, render_fps) \
+            + ' dropped: ' + str(handoff.dropped) \
+            + ' duplicated: ' + str(handoff.duplicated)
+        if point_filter is not None and point_filter.enabled:
+            status += ' points: %d -> %d' % (point_filter.last_in, point_filter.last_out)
+        sys.stdout.write(status)
+        sys.stdout.flush()
+        dt0 = datetime.now()
+
+
 def main(arg):
     """Main function of the script"""
     client = carla.Client(arg.host, arg.port)
     client.set_timeout(2.0)
     world = client.get_world()
+    ticker = None
+    point_filter = None
+    histogram = None
+    recorder = None
+    lidars = []
 
     try:
         original_settings = world.get_settings()
@@ -168,7 +872,7 @@ def main(arg):
         traffic_manager = client.get_trafficmanager(8000)
         traffic_manager.set_synchronous_mode(True)
 
-        delta = 0.05
+        delta = arg.delta
 
         settings.fixed_delta_seconds = delta
         settings.synchronous_mode = True
@@ -183,56 +887,70 @@ def main(arg):
 
         lidar_bp = generate_lidar_bp(arg, world, blueprint_library, delta)
 
-        user_offset = carla.Location(arg.x, arg.y, arg.z)
-        lidar_transform = carla.Transform(carla.Location(x=-0.5, z=1.8) + user_offset)
-
-        lidar = world.spawn_actor(lidar_bp, lidar_transform, attach_to=vehicle)
+        lidar_transforms = parse_lidar_mounts(arg)
+        for lidar_transform in lidar_transforms:
+            lidars.append(world.spawn_actor(lidar_bp, lidar_transform, attach_to=vehicle))
 
+        # The callbacks run on the sensor thread, they only hand the decoded
+        # scans over. Open3D is only touched from this thread
         point_list = o3d.geometry.PointCloud()
+        handoff = PointCloudHandoff()
+        point_filter = create_point_filter(arg)
         if arg.semantic:
-            lidar.listen(lambda data: semantic_lidar_callback(data, point_list))
+            histogram = LabelHistogram()
+            callback = lambda data: semantic_lidar_callback(data, handoff, point_filter, histogram)
         else:
-            lidar.listen(lambda data: lidar_callback(data, point_list))
-
-        vis = o3d.visualization.Visualizer()
-        vis.create_window(
-            window_name='Carla Lidar',
-            width=960,
-            height=540,
-            left=480,
-            top=270)
-        vis.get_render_option().background_color = [0.05, 0.05, 0.05]
-        vis.get_render_option().point_size = 1
-        vis.get_render_option().show_coordinate_frame = True
-
-        if arg.show_axis:
-            add_open3d_axis(vis)
-
-        frame = 0
-        dt0 = datetime.now()
-        while True:
-            if frame == 2:
-                vis.add_geometry(point_list)
-            vis.update_geometry(point_list)
+            callback = lambda data: lidar_callback(data, handoff, point_filter)
 
-            vis.poll_events()
-            vis.update_renderer()
-            # # This can fix Open3D jittering issues:
-            time.sleep(0.005)
-            world.tick()
+        if arg.record:
+            recorder = ScanRecorder(arg.record, semantic=arg.semantic, compress=arg.record_compress,
+                                    frame='vehicle' if arg.lidar_mounts else 'sensor')
 
-            process_time = datetime.now() - dt0
-            sys.stdout.write('\r' + 'FPS: ' + str(1.0 / process_time.total_seconds()))
-            sys.stdout.flush()
-            dt0 = datetime.now()
-            frame += 1
+            def record_and_show(data, callback=callback):
+                recorder.record(data)
+                callback(data)
+            callback = record_and_show
+
+        if arg.lidar_mounts:
+            # The scans of one frame are fused into the vehicle frame first,
+            # the fused cloud is shown and recorded like a single scan. A
+            # single mount goes through the fusion too, so its cloud is also
+            # in the vehicle frame
+            fusion = LidarFusion(lidar_transforms, semantic=arg.semantic, callback=callback)
+            for index, lidar in enumerate(lidars):
+                lidar.listen(lambda data, index=index: fusion.add(index, data))
+        else:
+            lidars[0].listen(callback)
+
+        vis = create_visualizer(arg)
+
+        if arg.tick_thread:
+            # The simulation runs at its own rate, the render loop shows
+            # the newest scan whenever it draws a frame
+            tick_rate = arg.tick_rate if arg.tick_rate is not None else 1.0 / delta
+            ticker = SimulationTicker(world, tick_rate)
+            ticker.start()
+            render_loop(vis, point_list, handoff, arg, ticker=ticker, point_filter=point_filter)
+        else:
+            render_loop(vis, point_list, handoff, arg, tick=world.tick, point_filter=point_filter)
 
     finally:
+        if ticker is not None:
+            ticker.stop()
+        if point_filter is not None and point_filter.enabled:
+            print('\nAverage points per scan: ' + point_filter.summary())
+        if histogram is not None and histogram.scans > 0:
+            print('\nSemantic lidar points per class over %d scans:' % histogram.scans)
+            print(histogram.summary())
         world.apply_settings(original_settings)
         traffic_manager.set_synchronous_mode(False)
 
         vehicle.destroy()
-        lidar.destroy()
+        for lidar in lidars:
+            lidar.destroy()
+        if recorder is not None:
+            recorder.close()
+            print('\nRecorded %d scans to %s' % (recorder.recorded, arg.record))
         vis.destroy_window()
 
 
@@ -318,7 +1036,104 @@ if __name__ == "__main__":
         default=0.0,
         type=float,
         help='offset in the sensor position in the Z-axis in meters (default: 0.0)')
+    argparser.add_argument(
+        '--delta',
+        default=0.05,
+        type=float,
+        help='fixed delta seconds of the simulation (default: 0.05)')
+    argparser.add_argument(
+        '--voxel-size',
+        default=None,
+        type=float,
+        help='downsample the points to one per voxel of this size in meters (default: off)')
+    argparser.add_argument(
+        '--roi',
+        default=None,
+        nargs=6,
+        type=float,
+        metavar=('XMIN', 'XMAX', 'YMIN', 'YMAX', 'ZMIN', 'ZMAX'),
+        help='only show points inside this box in meters, in the viewer coordinates (default: off)')
+    argparser.add_argument(
+        '--crop-range',
+        default=None,
+        type=float,
+        help='only show points closer than this distance in meters (default: off)')
+    argparser.add_argument(
+        '--remove-ground',
+        default=None,
+        type=float,
+        metavar='Z',
+        help='remove the points below this height in meters relative to the lidar, e.g. -1.7 (default: off)')
+    argparser.add_argument(
+        '--max-points',
+        default=None,
+        type=int,
+        help='maximum number of points shown per scan (default: off)')
+    argparser.add_argument(
+        '--lidar-mounts',
+        metavar='MOUNTS',
+        default=None,
+        help='spawn one lidar per mount and fuse their scans into the vehicle frame, e.g.'
+        ' "1.5,0.8,1.8,45;1.5,-0.8,1.8,-45;-1.5,0.8,1.8,135;-1.5,-0.8,1.8,-135" as x,y,z[,yaw[,pitch[,roll]]]'
+        ' separated by ";". The cloud is in the vehicle frame even with a single mount'
+        ' (default: one lidar at x=-0.5, z=1.8 in its sensor frame)')
+    argparser.add_argument(
+        '--record',
+        metavar='DIR',
+        default=None,
+        help='record every lidar scan into this directory (default: off)')
+    argparser.add_argument(
+        '--record-compress',
+        action='store_true',
+        help='compress the recorded segments with zlib')
+    argparser.add_argument(
+        '--replay',
+        metavar='DIR',
+        default=None,
+        help='show a recording made with --record instead of connecting to the simulator')
+    argparser.add_argument(
+        '--replay-speed',
+        default=1.0,
+        type=float,
+        help='replay speed relative to the recorded timestamps, 0 is as fast as possible (default: 1.0)')
+    argparser.add_argument(
+        '--tick-thread',
+        action='store_true',
+        help='tick the simulator from a dedicated thread instead of once per rendered frame')
+    argparser.add_argument(
+        '--tick-rate',
+        default=None,
+        type=float,
+        help='simulation ticks per second with --tick-thread, 0 ticks as fast as possible (default: 1 / delta)')
+    argparser.add_argument(
+        '--render-fps',
+        default=0.0,
+        type=float,
+        help='maximum frames per second of the visualizer, 0 is uncapped (default: 0)')
+    argparser.add_argument(
+        '--benchmark',
+        action='store_true',
+        help='measure the lidar decoding on synthetic scans without connecting to the simulator')
+    argparser.add_argument(
+        '--benchmark-frames',
+        default=400,
+        type=int,
+        help='number of synthetic scans decoded by --benchmark (default: 400)')
     args = argparser.parse_args()
+    # Checked before connecting, ScanRecorder refuses the directory as well
+    if args.record and os.path.exists(os.path.join(args.record, 'index.jsonl')):
+        argparser.error('--record %s already holds a recording' % args.record)
+
+    if args.benchmark:
+        benchmark(args)
+        sys.exit(0)
+
+    if args.replay:
+        try:
+            replay(args)
+        except KeyboardInterrupt:
+            print(' - Exited by user.')
+        sys.exit(0)
 
     try:
         main(args)
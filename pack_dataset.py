@@ -0,0 +1,151 @@
+import argparse
+'''
+Packs the samples of CARLA_Data into one memory-mapped .npy array per field plus an index.json file.
+Reading a packed sample is an index into these arrays instead of decoding images, point clouds and
+json files (or unpickling diskcache entries) in every dataloader worker.
+The arrays are opened read-only, so all processes on a node share them through the page cache.
+The samples are packed with data augmentation disabled (config.augment = False). A packed sample is a fixed
+array, a random rotation or shift drawn while packing would be the same in every epoch. Training on a packed
+dataset therefore runs without augmentation, train.py requires --augment 0 with --packed_data_dir.
+The settings the samples depend on are recorded in index.json and checked by train.py, pass the same
+--backbone, --n_layer, --use_target_point_image and --use_point_pillars values to both scripts.
+
+    python pack_dataset.py --root_dir /path/to/dataset --out_dir $SCRATCH/packed_dataset
+    python train.py --packed_data_dir $SCRATCH/packed_dataset --augment 0 ...
+'''
+import json
+import os
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+
+INDEX_FILE = 'index.json'
+
+
+def pack_dataset(dataset, out_dir, num_workers=8, settings=None):
+    """
+    Writes every field of the samples of dataset into out_dir/<field>.npy.
+    settings is the dict of training arguments the samples were created with, it is stored in the index.
+    Only fields whose shape is the same for all samples can be packed, variable sized fields raise an error.
+    The index file is written last, a directory without it is an incomplete pack.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    num_samples = len(dataset)
+    # batch_size=None returns the samples one by one, the workers only parallelize the decoding.
+    loader = DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers, collate_fn=to_numpy,
+                        worker_init_fn=seed_worker)
+
+    arrays = None
+    fields = {}
+    for idx, sample in enumerate(tqdm(loader, total=num_samples)):
+        if (arrays is None):
+            arrays = {}
+            for key, value in sample.items():
+                # Fixed shape fields are stored as one array with an additional leading sample dimension.
+                file_name = key + '.npy'
+                arrays[key] = np.lib.format.open_memmap(os.path.join(out_dir, file_name), mode='w+',
+                                                        dtype=value.dtype, shape=(num_samples,) + value.shape)
+                fields[key] = {'file': file_name, 'dtype': value.dtype.str, 'shape': list(value.shape)}
+
+        for key, array in arrays.items():
+            value = sample[key]
+            if (value.shape != array.shape[1:]):
+                raise ValueError('Field %s of sample %d has shape %s but %s was expected. Only fixed shape fields can be packed.'
+                                 % (key, idx, value.shape, array.shape[1:]))
+            array[idx] = value
+
+    if (arrays is None):
+        raise ValueError('The dataset is empty, there is nothing to pack.')
+    for array in arrays.values():
+        array.flush()
+
+    with open(os.path.join(out_dir, INDEX_FILE), 'w') as f:
+        json.dump({'num_samples': num_samples, 'augmented': False, 'settings': settings or {}, 'fields': fields}, f, indent=2)
+
+
+def seed_worker(worker_id):
+    # Same as in train.py, forked workers would otherwise share the numpy and random state of the main process.
+    worker_seed = (torch.initial_seed()) % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+def to_numpy(sample):
+    return {key: np.asarray(value.numpy() if torch.is_tensor(value) else value) for key, value in sample.items()}
+
+
+class PackedCARLA_Data(Dataset):
+    """
+    Read path for datasets written by pack_dataset. Returns read-only numpy views into the memory-mapped arrays,
+    the only copy happens when collate_packed stacks them into a batch.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+        # The arrays are opened lazily so that every dataloader worker maps the files itself after forking.
+        self.arrays = None
+
+    def __len__(self):
+        return self.index['num_samples']
+
+    @property
+    def settings(self):
+        # Datasets packed before the settings were recorded have none, train.py then reports every setting.
+        return self.index.get('settings', {})
+
+    def open(self):
+        self.arrays = {key: np.load(os.path.join(self.root, field['file']), mmap_mode='r')
+                       for key, field in self.index['fields'].items()}
+
+    def __getitem__(self, index):
+        if (self.arrays is None):
+            self.open()
+        return {key: array[index] for key, array in self.arrays.items()}
+
+
+def collate_packed(batch):
+    # np.stack copies the memory-mapped views into one writable batch array, torch.from_numpy does not copy again.
+    return {key: torch.from_numpy(np.stack([sample[key] for sample in batch])) for key in batch[0].keys()}
+
+
+def main():
+    from config import GlobalConfig
+    from data import CARLA_Data
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root_dir', type=str, required=True, help='Root directory of your training data')
+    parser.add_argument('--out_dir', type=str, required=True, help='Directory the packed dataset is written to. Contains a train and a val folder.')
+    parser.add_argument('--setting', type=str, default='all', help='Training setting, see train.py.')
+    parser.add_argument('--use_target_point_image', type=int, default=1, help='Needs to match the value used for training.')
+    parser.add_argument('--use_point_pillars', type=int, default=0, help='Needs to match the value used for training.')
+    parser.add_argument('--backbone', type=str, default='transFuser', help='Needs to match the value used for training.')
+    parser.add_argument('--n_layer', type=int, default=4, help='Needs to match the value used for training.')
+    parser.add_argument('--num_workers', type=int, default=8, help='Number of processes that decode the samples.')
+    args = parser.parse_args()
+
+    # The samples depend on the config, it is set up the same way as in train.py.
+    config = GlobalConfig(root_dir=args.root_dir, setting=args.setting)
+    config.use_target_point_image = bool(args.use_target_point_image)
+    config.use_point_pillars = bool(args.use_point_pillars)
+    config.n_layer = args.n_layer
+    config.backbone = args.backbone
+    # A random augmentation would be stored as a single draw per sample, see the module docstring.
+    config.augment = False
+
+    # Checked by train.py when the packed dataset is loaded.
+    settings = {'backbone': args.backbone, 'n_layer': args.n_layer,
+                'use_target_point_image': bool(args.use_target_point_image), 'use_point_pillars': bool(args.use_point_pillars)}
+    pack_dataset(CARLA_Data(root=config.train_data, config=config), os.path.join(args.out_dir, 'train'),
+                 num_workers=args.num_workers, settings=settings)
+    pack_dataset(CARLA_Data(root=config.val_data, config=config), os.path.join(args.out_dir, 'val'),
+                 num_workers=args.num_workers, settings=settings)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,7 +20,12 @@ except IndexError:
 
 import carla
 
+import argparse
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 try:
     import pygame
@@ -38,6 +43,9 @@ except ImportError:
     import Queue as queue
 
 
+SYNC_POLICIES = ('strict', 'drop', 'partial', 'carry')
+
+
 class CarlaSyncMode(object):
     """
     Context manager to synchronize output from different sensors. Synchronous
@@ -47,6 +55,20 @@ class CarlaSyncMode(object):
             while True:
                 data = sync_mode.tick(timeout=1.0)
 
+    The timeout of tick is the total time to wait for all sensors. The policy
+    keyword decides what happens if a sensor missed it:
+
+        strict   raises queue.Empty, the original behavior
+        drop     tick returns None, the whole frame is skipped
+        partial  the missing sensors are None
+        carry    the missing sensors repeat their last data (None before the first)
+
+    Per-sensor latency, stale and dropped counts are kept in self.metrics.
+
+    The decoders keyword takes one function per sensor (or None), e.g.
+    decode_rgb. It is applied in a thread pool of decode_workers threads as
+    soon as the data arrives and tick returns its result instead of the raw
+    sensor data.
     """
     # accepts keyword arguments (**kwargs).
     def __init__(self, world, *sensors, **kwargs):
@@ -55,39 +77,83 @@ class CarlaSyncMode(object):
         self.frame = None
         # If no fps value is provided, it defaults to 20 frames per second.
         self.delta_seconds = 1.0 / kwargs.get('fps', 20)
+        self.policy = kwargs.get('policy', 'strict')
+        if self.policy not in SYNC_POLICIES:
+            raise ValueError('unknown sync policy %r, expected one of %s' % (self.policy, ', '.join(SYNC_POLICIES)))
         # initializes an empty list to hold the sensor data queues.
         self._queues = []
+        # Data of a later frame that arrived while waiting for the current one
+        self._early = []
+        self._last = []
+        self._decoded = []
         self._settings = None
+        self.dropped_frames = 0
+        self.metrics = []
+        self.decoders = list(kwargs.get('decoders', [])) + [None] * len(sensors)
+        self._executor = None
+        self._closed = False
+        if any(self.decoders):
+            decode_workers = kwargs.get('decode_workers', 4)
+            if decode_workers < 1:
+                raise ValueError('decoders need at least one decode worker, got decode_workers=%d' % decode_workers)
+            self._executor = ThreadPoolExecutor(max_workers=decode_workers)
 
     # 该方法与 with 语句结合使用，进入上下文时执行
     def __enter__(self):
         self._settings = self.world.get_settings()
-        self.frame = self.world.apply_settings(carla.WorldSettings(
-            no_rendering_mode=False,
-            synchronous_mode=True,
-            fixed_delta_seconds=self.delta_seconds))
-
-        def make_queue(register_event):
+        # get_settings returns a new copy, the original settings stay untouched
+        settings = self.world.get_settings()
+        settings.no_rendering_mode = False
+        settings.synchronous_mode = True
+        settings.fixed_delta_seconds = self.delta_seconds
+        self.frame = self.world.apply_settings(settings)
+
+        def make_queue(register_event, name, decoder=None):
             q = queue.Queue()
-            # registers the function as an event handler for that queue
-            register_event(q.put)
+            # registers the function as an event handler for that queue,
+            # the arrival time is stored next to the data for the latency metrics
+            if decoder is None:
+                register_event(lambda data: q.put((time.time(), data.frame, data)))
+            else:
+                # The decoding starts right away, the queue holds its future
+                register_event(lambda data: self._decode(q, decoder, data))
             self._queues.append(q)
+            self._decoded.append(decoder is not None)
+            self._early.append(None)
+            self._last.append(None)
+            self.metrics.append(SensorMetrics(name))
 
-        make_queue(self.world.on_tick)
+        make_queue(self.world.on_tick, 'world')
         # creates a queue for each sensor and registers sensor.
         # listen as the event handler
-        for sensor in self.sensors:
-            make_queue(sensor.listen)
+        for index, sensor in enumerate(self.sensors):
+            make_queue(sensor.listen, getattr(sensor, 'type_id', 'sensor %d' % index), self.decoders[index])
 
         # 返回类本身的实例。这允许实例在 with 语句创建的上下文中使用。
         return self
 
     def tick(self, timeout):
         # updates the frame attribute of the class with the new frame
+        start = time.time()
         self.frame = self.world.tick()
-        data = [self._retrieve_data(q, timeout) for q in self._queues]
-        # verifies that the frame number of the retrieved data matches the current frame number
-        assert all(x.frame == self.frame for x in data)
+        # One deadline for all queues, a late sensor does not add its own timeout
+        deadline = start + timeout
+        data = [self._retrieve_data(index, deadline, start) for index in range(len(self._queues))]
+        missing = [index for index, x in enumerate(data) if x is None]
+        if not missing:
+            return data
+
+        if self.policy == 'strict':
+            raise queue.Empty('no data of frame %d from %s within %.3f s' % (
+                self.frame, ', '.join(self.metrics[index].name for index in missing), timeout))
+        if self.policy == 'drop':
+            self.dropped_frames += 1
+            return None
+        if self.policy == 'carry':
+            for index in missing:
+                data[index] = self._last[index]
+                if data[index] is not None:
+                    self.metrics[index].carried += 1
         return data
 
     '''
@@ -98,21 +164,123 @@ class CarlaSyncMode(object):
     '''
     def __exit__(self, *args, **kwargs):
         self.world.apply_settings(self._settings)
-
-    def _retrieve_data(self, sensor_queue, timeout):
+        # The sensors stop delivering before the decode pool goes away, data
+        # already on its way is ignored by _decode
+        for sensor in self.sensors:
+            sensor.stop()
+        self._closed = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def _decode(self, sensor_queue, decoder, data):
+        arrival = time.time()
+        if self._closed:
+            return
+        try:
+            future = self._executor.submit(decoder, data)
+        except RuntimeError:
+            # The pool was shut down between the check and the submit
+            return
+        sensor_queue.put((arrival, data.frame, future))
+
+    def _retrieve_data(self, index, deadline, start):
+        sensor_queue = self._queues[index]
+        metrics = self.metrics[index]
         while True:
-            data = sensor_queue.get(timeout=timeout)
+            if self._early[index] is not None:
+                item = self._early[index]
+                self._early[index] = None
+            else:
+                try:
+                    item = sensor_queue.get(timeout=max(deadline - time.time(), 0.0))
+                except queue.Empty:
+                    metrics.dropped += 1
+                    return None
+            arrival, frame, data = item
             # if the frame number of the retrieved data matches the current frame number.
-            if data.frame == self.frame:
+            if frame == self.frame:
+                if self._decoded[index]:
+                    try:
+                        data = data.result(timeout=max(deadline - time.time(), 0.0))
+                    except FutureTimeoutError:
+                        metrics.dropped += 1
+                        return None
+                metrics.add_latency(max(arrival - start, 0.0))
+                self._last[index] = data
                 return data
-
-
-def draw_image(surface, image, blend=False):
+            if frame > self.frame:
+                # The sensor skipped the current frame, keep its data for the next tick
+                self._early[index] = item
+                metrics.dropped += 1
+                return None
+            metrics.stale += 1
+
+    def summary(self):
+        """Returns one line of metrics per sensor"""
+        lines = ['%d dropped frames' % self.dropped_frames] if self.policy == 'drop' else []
+        return '\n'.join(lines + [str(metrics) for metrics in self.metrics])
+
+
+class SensorMetrics(object):
+    """Latency from world.tick to the arrival of the data of one sensor, and
+    the number of stale (older frame), dropped (missed the deadline) and
+    carried (replaced by the last data) frames"""
+
+    def __init__(self, name):
+        self.name = name
+        self.received = 0
+        self.stale = 0
+        self.dropped = 0
+        self.carried = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def add_latency(self, latency):
+        self.received += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    @property
+    def latency_mean(self):
+        return self.latency_sum / max(self.received, 1)
+
+    def __str__(self):
+        return '%-36s received %6d  latency mean %7.2f ms max %7.2f ms  stale %4d  dropped %4d  carried %4d' % (
+            self.name, self.received, 1000.0 * self.latency_mean, 1000.0 * self.latency_max,
+            self.stale, self.dropped, self.carried)
+
+
+def decode_bgra(image):
+    """Returns the HxWx3 rgb view of a camera image, no copy"""
     array = np.frombuffer(image.raw_data, dtype=np.dtype("uint8"))
     array = np.reshape(array, (image.height, image.width, 4))
     array = array[:, :, :3]
-    array = array[:, :, ::-1]
-    image_surface = pygame.surfarray.make_surface(array.swapaxes(0, 1))
+    return array[:, :, ::-1]
+
+
+def decode_rgb(image):
+    """Returns a contiguous HxWx3 rgb copy of a camera image, draw_image blits it without another copy"""
+    return np.ascontiguousarray(decode_bgra(image))
+
+
+def decode_semseg(image):
+    """Returns the CityScapes colored contiguous HxWx3 rgb copy of a semantic segmentation image"""
+    image.convert(carla.ColorConverter.CityScapesPalette)
+    return decode_rgb(image)
+
+
+def decode_lidar(measurement):
+    """Returns the Nx4 x, y, z, intensity view of a lidar measurement"""
+    return np.frombuffer(measurement.raw_data, dtype=np.dtype('f4')).reshape(-1, 4)
+
+
+def draw_image(surface, image, blend=False):
+    # image is a carla.Image or a contiguous HxWx3 rgb array from decode_rgb,
+    # the array is wrapped in a surface without copying it
+    if isinstance(image, np.ndarray):
+        image_surface = pygame.image.frombuffer(image, (image.shape[1], image.shape[0]), 'RGB')
+    else:
+        image_surface = pygame.surfarray.make_surface(decode_bgra(image).swapaxes(0, 1))
     if blend:
         image_surface.set_alpha(100)
     surface.blit(image_surface, (0, 0))
@@ -142,8 +310,132 @@ def should_quit():
     return False
 
 
+class FakeData(object):
+    """Stand-in for a world snapshot or sensor measurement"""
+
+    def __init__(self, frame):
+        self.frame = frame
+
+
+class FakeSensor(object):
+    """Stand-in for a carla sensor that delivers each frame after delay
+    seconds from its own thread and skips the frames in drop"""
+
+    def __init__(self, type_id, delay=0.0, drop=()):
+        self.type_id = type_id
+        self.delay = delay
+        self.drop = set(drop)
+        self._callback = None
+
+    def listen(self, callback):
+        self._callback = callback
+
+    def stop(self):
+        self._callback = None
+
+    def emit(self, frame):
+        callback = self._callback
+        if callback is not None and frame not in self.drop:
+            timer = threading.Timer(self.delay, callback, [FakeData(frame)])
+            timer.daemon = True
+            timer.start()
+
+
+class FakeWorld(object):
+    """Stand-in for carla.World, every tick makes the sensors emit the new frame"""
+
+    def __init__(self, sensors):
+        self.sensors = sensors
+        self.frame = 0
+        self._callbacks = []
+
+    def get_settings(self):
+        return FakeData(self.frame)
+
+    def apply_settings(self, settings):
+        return self.frame
+
+    def on_tick(self, callback):
+        self._callbacks.append(callback)
+
+    def tick(self):
+        self.frame += 1
+        for callback in self._callbacks:
+            callback(FakeData(self.frame))
+        for sensor in self.sensors:
+            sensor.emit(self.frame)
+        return self.frame
+
+
+def self_test(timeout=0.1):
+    """Runs every policy against a fake world without a simulator. The
+    flaky sensor skips frames 3 and 4, the stuck one never delivers in time"""
+    frames = 6
+    expected = {
+        'strict': [[1, 1, 1], [2, 2, 2], 'Empty', 'Empty', [5, 5, 5], [6, 6, 6]],
+        'drop': [[1, 1, 1], [2, 2, 2], None, None, [5, 5, 5], [6, 6, 6]],
+        'partial': [[1, 1, 1], [2, 2, 2], [3, 3, None], [4, 4, None], [5, 5, 5], [6, 6, 6]],
+        'carry': [[1, 1, 1], [2, 2, 2], [3, 3, 2], [4, 4, 2], [5, 5, 5], [6, 6, 6]],
+    }
+    for policy in SYNC_POLICIES:
+        fast = FakeSensor('fast', delay=0.001)
+        flaky = FakeSensor('flaky', delay=0.02, drop=(3, 4))
+        results = []
+        with CarlaSyncMode(FakeWorld([fast, flaky]), fast, flaky, policy=policy) as sync_mode:
+            for _ in range(frames):
+                try:
+                    data = sync_mode.tick(timeout=timeout)
+                except queue.Empty:
+                    results.append('Empty')
+                    continue
+                results.append(None if data is None else [None if x is None else x.frame for x in data])
+        assert results == expected[policy], (policy, results)
+        assert sync_mode.metrics[2].dropped == 2, (policy, str(sync_mode.metrics[2]))
+        assert sync_mode.metrics[2].carried == (2 if policy == 'carry' else 0), (policy, str(sync_mode.metrics[2]))
+        print('%-8s ok  %s' % (policy, results))
+
+    # The timeout bounds the whole tick, not every queue
+    stuck = [FakeSensor('stuck %d' % i, delay=10.0 * timeout) for i in range(4)]
+    with CarlaSyncMode(FakeWorld(stuck), *stuck, policy='partial') as sync_mode:
+        start = time.time()
+        data = sync_mode.tick(timeout=timeout)
+        elapsed = time.time() - start
+    assert data[1:] == [None] * len(stuck), data
+    assert elapsed < 2.0 * timeout, elapsed
+    print('deadline ok  %d stuck sensors, tick took %.3f s with timeout %.3f s' % (len(stuck), elapsed, timeout))
+
+
 def main():
+    argparser = argparse.ArgumentParser(
+        description='CARLA synchronous mode example')
+    argparser.add_argument(
+        '--sync-policy',
+        choices=SYNC_POLICIES,
+        default='strict',
+        help='what to do if a sensor misses the tick timeout (default: strict)')
+    argparser.add_argument(
+        '--decode-workers',
+        default=4,
+        type=int,
+        help='threads that decode the camera images as soon as they arrive, 0 decodes them on the game thread'
+        ' (default: 4)')
+    argparser.add_argument(
+        '--timeout',
+        default=2.0,
+        type=float,
+        help='total seconds to wait for all sensors per tick (default: 2.0)')
+    argparser.add_argument(
+        '--self-test',
+        action='store_true',
+        help='check the sync policies against a fake world and sensors, no simulator needed')
+    args = argparser.parse_args()
+
+    if args.self_test:
+        self_test()
+        return
+
     actor_list = []
+    sync_mode = None
     pygame.init()
 
     display = pygame.display.set_mode(
@@ -184,7 +476,10 @@ def main():
         actor_list.append(camera_semseg)
 
         # Create a synchronous mode context.
-        with CarlaSyncMode(world, camera_rgb, camera_semseg, fps=30) as sync_mode:
+        decoders = [decode_rgb, decode_semseg] if args.decode_workers > 0 else []
+        sync_mode = CarlaSyncMode(world, camera_rgb, camera_semseg, fps=30, policy=args.sync_policy,
+                                  decoders=decoders, decode_workers=args.decode_workers)
+        with sync_mode:
             while True:
                 if should_quit():
                     return
@@ -192,7 +487,11 @@ def main():
                 clock.tick()
 
                 # Advance the simulation and wait for the data.
-                snapshot, image_rgb, image_semseg = sync_mode.tick(timeout=2.0)
+                data = sync_mode.tick(timeout=args.timeout)
+                if data is None or data[0] is None:
+                    # The frame was dropped, see --sync-policy
+                    continue
+                snapshot, image_rgb, image_semseg = data
 
                 # Choose the next waypoint and update the car location.
                 waypoint = random.choice(waypoint.next(1.5))
@@ -200,15 +499,21 @@ def main():
 
                 # By mapping the pixel values to colors in the CityScapes palette, 
                 # the resulting image can provide a better understanding of the segmentation output.
-                image_semseg.convert(carla.ColorConverter.CityScapesPalette)
+                # With decode workers this already happened in decode_semseg.
+                # With the partial and carry policies a sensor that missed the frame is None,
+                # the sensors that arrived are still drawn.
+                if not decoders and image_semseg is not None:
+                    image_semseg.convert(carla.ColorConverter.CityScapesPalette)
                 # represents the time difference (in seconds) between 
                 # the current snapshot and the previous snapshot.
                 # rounds the calculated FPS to the nearest whole numbe
                 fps = round(1.0 / snapshot.timestamp.delta_seconds)
 
                 # Draw the display.
-                draw_image(display, image_rgb)
-                draw_image(display, image_semseg, blend=True)
+                if image_rgb is not None:
+                    draw_image(display, image_rgb)
+                if image_semseg is not None:
+                    draw_image(display, image_semseg, blend=True)
                 display.blit(
                     font.render('% 5d FPS (real)' % clock.get_fps(), True, (255, 255, 255)),
                     (8, 10))
@@ -219,6 +524,8 @@ def main():
 
     finally:
 
+        if sync_mode is not None:
+            print(sync_mode.summary())
         print('destroying actors.')
         for actor in actor_list:
             actor.destroy()
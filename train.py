@@ -7,6 +7,12 @@ json.load(): This function reads JSON data from a file and returns Python object
 '''
 import json
 import os
+import re
+import collections
+import itertools
+import contextlib
+import concurrent.futures
+import time
 from tqdm import tqdm
 
 import numpy as np
@@ -29,6 +35,7 @@ from torch.utils.tensorboard import SummaryWriter
 from config import GlobalConfig
 from model import LidarCenterNet
 from data import CARLA_Data, lidar_bev_cam_correspondences
+from pack_dataset import PackedCARLA_Data, collate_packed
 
 '''
 provides an object-oriented interface for working with file system paths. 
@@ -108,14 +115,38 @@ def main():
     parser.add_argument('--sync_batch_norm', type=int, default=0, help='0: Compute batch norm for each GPU independently, 1: Synchronize Batch norms accross GPUs. Only use with --parallel_training 1')
     parser.add_argument('--zero_redundancy_optimizer', type=int, default=0, help='0: Normal AdamW Optimizer, 1: Use Zero Reduncdancy Optimizer to reduce memory footprint. Only use with --parallel_training 1')
     parser.add_argument('--use_disk_cache', type=int, default=0, help='0: Do not cache the dataset 1: Cache the dataset on the disk pointed to by the SCRATCH enironment variable. Useful if the dataset is stored on slow HDDs and can be temporarily stored on faster SSD storage.')
+    parser.add_argument('--resume', type=int, default=0, help='1: Continue the training from the resume state in the logdir, including the epoch, step, optimizer, random number generators and learning rate schedule. --load_file and --start_epoch are then ignored.')
+    parser.add_argument('--checkpoint_every_n_steps', type=int, default=0, help='Additionally write the resume state every n training steps so that preempted jobs can continue in the middle of an epoch. 0: Only write it at the end of every epoch.')
+    parser.add_argument('--async_checkpoint', type=int, default=1, help='1: Write checkpoints in a background thread, 0: Block training until the checkpoint is written.')
+    parser.add_argument('--checkpoint_format', type=str, default='full', choices=['full', 'sharded'], help='full: Rank 0 writes the whole optimizer state. sharded: With --zero_redundancy_optimizer 1 every rank writes its own optimizer shard, which avoids gathering the state on one GPU. Sharded checkpoints need the same number of GPUs to be loaded.')
+    parser.add_argument('--keep_last_k', type=int, default=0, help='Only keep the checkpoints of the last k epochs in the logdir. 0: Keep all checkpoints.')
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'fp16', 'bf16'], help='Mixed precision training. off: fp32, fp16: float16 autocast with gradient scaling, bf16: bfloat16 autocast.')
+    parser.add_argument('--grad_accum_steps', type=int, default=1, help='Number of batches whose gradients are accumulated before each optimizer step. The effective batch size becomes batch_size*num_gpus*grad_accum_steps')
+    parser.add_argument('--log_every_n_steps', type=int, default=0, help='Log the training loss of every n-th step to tensorboard. 0: Only log the epoch averages. Logging a step requires a GPU synchronization.')
+    parser.add_argument('--bucket_point_pillars', type=int, default=0, help='1: Batch samples with similar lidar point counts together and only copy the valid points to the GPU. Only used with --use_point_pillars 1. Requires --packed_data_dir, the point counts are read from the packed num_points array.')
+    parser.add_argument('--packed_data_dir', type=str, default=None, help='Directory of a dataset packed with pack_dataset.py. The memory-mapped arrays are read instead of the raw data, --root_dir and --use_disk_cache are then not used for loading. Requires --augment 0 and the --backbone, --n_layer, --use_target_point_image and --use_point_pillars values the dataset was packed with.')
+    parser.add_argument('--augment', type=int, default=1, help='1: Augment the training samples with random rotations and shifts (config.augment). Packed samples are not augmented, --packed_data_dir requires --augment 0.')
+    parser.add_argument('--num_workers', type=int, default=-1, help='Number of dataloader worker processes per GPU. -1: 8 with --parallel_training 1 and 0 otherwise.')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='Number of batches loaded in advance by each dataloader worker. Only used with num_workers > 0.')
+    parser.add_argument('--persistent_workers', type=int, default=0, help='1: Keep the dataloader workers alive between epochs instead of starting them again every epoch. Only used with num_workers > 0.')
+    parser.add_argument('--autotune_workers', type=int, default=0, help='If > 0, time this many batches for several worker counts before training and use the fastest one. Overrides --num_workers.')
+    parser.add_argument('--profile', type=int, default=0, help='1: Record the time per step spent in data loading, host to device copy, forward, backward, optimizer step and logging. Written to tensorboard and to profile_rank<r>.json in the logdir.')
+    parser.add_argument('--profile_trace_steps', type=str, default='', help='Capture a torch.profiler trace of the training steps start,end (e.g. 10,20) into trace_rank<r> in the logdir.')
+    parser.add_argument('--prefetch_batches', type=int, default=1, help='Number of batches that are copied to the GPU ahead of time on a side CUDA stream. 0: Copy every batch synchronously before using it.')
 
 
     args = parser.parse_args()
     # /logs, experiment1 -> /logs/experiment1
     args.logdir = os.path.join(args.logdir, args.id) 
     parallel = bool(args.parallel_training)
-
-    if(bool(args.use_disk_cache) == True):
+    if ((bool(args.bucket_point_pillars) == True) and (args.packed_data_dir is None)):
+        # Counting the points of a raw dataset would decode every sample on every rank before training starts.
+        parser.error('--bucket_point_pillars 1 requires --packed_data_dir, pack the dataset with pack_dataset.py --use_point_pillars 1.')
+    if ((bool(args.augment) == True) and (args.packed_data_dir is not None)):
+        # A packed sample is a fixed array, training on it would silently run without augmentation.
+        parser.error('--packed_data_dir requires --augment 0, packed datasets are written without data augmentation.')
+
+    if((bool(args.use_disk_cache) == True) and (args.packed_data_dir is None)):
         if (parallel == True):
             # NOTE: This is specific to our cluster setup where the data is stored on slow storage.
             # During training we cache the dataset on the fast storage of the local compute nodes.
@@ -177,6 +208,7 @@ def main():
     config.n_layer = args.n_layer
     config.use_point_pillars = bool(args.use_point_pillars)
     config.backbone = args.backbone
+    config.augment = bool(args.augment)
     if(bool(args.no_bev_loss)):
         # It assumes that "loss_bev" is present in the list 
         # and assigns the index to the variable index_bev.
@@ -228,8 +260,23 @@ def main():
     print ('Total trainable parameters: ', params)
 
     # Data
-    train_set = CARLA_Data(root=config.train_data, config=config, shared_dict=shared_dict)
-    val_set   = CARLA_Data(root=config.val_data,   config=config, shared_dict=shared_dict)
+    if (args.packed_data_dir is not None):
+        # Memory-mapped arrays written by pack_dataset.py, they replace decoding and the disk cache.
+        train_set = PackedCARLA_Data(os.path.join(args.packed_data_dir, 'train'))
+        val_set   = PackedCARLA_Data(os.path.join(args.packed_data_dir, 'val'))
+        collate_fn = collate_packed
+        settings = {'backbone': args.backbone, 'n_layer': args.n_layer,
+                    'use_target_point_image': bool(args.use_target_point_image), 'use_point_pillars': bool(args.use_point_pillars)}
+        for packed_set in (train_set, val_set):
+            mismatches = ['--%s %s (packed with %s)' % (key, value, packed_set.settings.get(key))
+                          for key, value in settings.items() if packed_set.settings.get(key) != value]
+            if (len(mismatches) > 0):
+                parser.error('%s was packed with different settings: %s. Pack the dataset again with pack_dataset.py.'
+                             % (packed_set.root, ', '.join(mismatches)))
+    else:
+        train_set = CARLA_Data(root=config.train_data, config=config, shared_dict=shared_dict)
+        val_set   = CARLA_Data(root=config.val_data,   config=config, shared_dict=shared_dict)
+        collate_fn = None
 
     # The generator is used to generate random numbers and 
     # provides control over the randomness in PyTorch operations.
@@ -254,13 +301,32 @@ def main():
             The shuffling of data ensures that the order in which data is presented to each process is different in each epoch, 
             further enhancing the randomness and preventing any potential biases.
         '''
-        sampler_train = torch.utils.data.distributed.DistributedSampler(train_set, shuffle=True, num_replicas=world_size, rank=rank)
+        sampler_train = ResumableSampler(torch.utils.data.distributed.DistributedSampler(train_set, shuffle=True, num_replicas=world_size, rank=rank))
         sampler_val   = torch.utils.data.distributed.DistributedSampler(val_set,   shuffle=True, num_replicas=world_size, rank=rank)
-        dataloader_train = DataLoader(train_set, sampler=sampler_train, batch_size=args.batch_size, worker_init_fn=seed_worker, generator=g_cuda, num_workers=8, pin_memory=True)
-        dataloader_val   = DataLoader(val_set,   sampler=sampler_val,   batch_size=args.batch_size, worker_init_fn=seed_worker, generator=g_cuda, num_workers=8, pin_memory=True)
     else:
-      dataloader_train = DataLoader(train_set, shuffle=True, batch_size=args.batch_size, worker_init_fn=seed_worker, generator=g_cuda, num_workers=0, pin_memory=True)
-      dataloader_val   = DataLoader(val_set,   shuffle=True, batch_size=args.batch_size, worker_init_fn=seed_worker, generator=g_cuda, num_workers=0, pin_memory=True)
+      # Same as shuffle=True, but the sampler can skip the beginning of an epoch when resuming.
+      sampler_train = ResumableSampler(torch.utils.data.RandomSampler(train_set, generator=g_cuda))
+      sampler_val   = torch.utils.data.RandomSampler(val_set, generator=g_cuda)
+
+    if ((bool(args.bucket_point_pillars) == True) and (config.use_point_pillars == True)):
+        # Groups samples with similar point counts and only transfers the valid points of every cloud.
+        # In parallel training the sampler splits the data across ranks like the DistributedSampler.
+        if (parallel == True):
+            bucket_sampler = PointCountBucketSampler(get_point_counts(train_set), args.batch_size, num_replicas=world_size, rank=rank)
+        else:
+            bucket_sampler = PointCountBucketSampler(get_point_counts(train_set), args.batch_size, generator=g_cuda)
+        sampler_train = ResumableSampler(bucket_sampler, batch_sampler=True)
+        collate_fn = PackedPointsCollate(collate_fn)
+
+    if (args.autotune_workers > 0):
+        num_workers = autotune_num_workers(train_set, args, parallel, device, collate_fn)
+    elif (args.num_workers >= 0):
+        num_workers = args.num_workers
+    else:
+        num_workers = 8 if (parallel == True) else 0
+
+    dataloader_train = make_dataloader(train_set, sampler_train, args, num_workers, g_cuda, collate_fn)
+    dataloader_val   = make_dataloader(val_set,   sampler_val,   args, num_workers, g_cuda, collate_fn)
 
     # Create logdir
     # isdir: determine if the path corresponds to an existing directory.
@@ -287,12 +353,19 @@ def main():
         # map_location parameter is set to model.device to ensure that the loaded model parameters are mapped to the correct device.
         model.load_state_dict(torch.load(args.load_file, map_location=model.device))
         # This line loads the state dictionary of the optimizer from a separate checkpoint file
-        optimizer.load_state_dict(torch.load(args.load_file.replace("model_", "optimizer_"), map_location=model.device))
+        load_optimizer_state(optimizer, args.load_file.replace("model_", "optimizer_"), rank, model.device)
 
 
     trainer = Engine(model=model, optimizer=optimizer, dataloader_train=dataloader_train, dataloader_val=dataloader_val,
                      args=args, config=config, writer=writer, device=device, rank=rank, world_size=world_size,
-                     parallel=parallel, cur_epoch=args.start_epoch)
+                     parallel=parallel, cur_epoch=args.start_epoch, generator=g_cuda, sampler_train=sampler_train)
+
+    if (bool(args.resume) == True):
+        if os.path.isfile(trainer.resume_file(0)):
+            print("=============resume=================")
+            trainer.load_resume_state()
+        else:
+            print("No resume state found in", args.logdir, "starting a new training.")
 
     for epoch in range(trainer.cur_epoch, args.epochs):
         if(parallel == True):
@@ -306,7 +379,9 @@ def main():
             this code snippet implements a learning rate schedule where the learning 
             rate is reduced by a factor of 10 at specific epochs during training.
         '''
-        if ((epoch == args.schedule_reduce_epoch_01) or (epoch==args.schedule_reduce_epoch_02)) and (args.schedule == 1):
+        # When resuming in the middle of an epoch the reduction of that epoch is already part of the optimizer state.
+        if ((epoch == args.schedule_reduce_epoch_01) or (epoch==args.schedule_reduce_epoch_02)) and (args.schedule == 1) and (epoch not in trainer.lr_reductions):
+            trainer.lr_reductions.append(epoch)
             current_lr = optimizer.param_groups[0]['lr']
             new_lr = current_lr * 0.1
             print("Reduce learning rate by factor 10 to:", new_lr)
@@ -319,29 +394,33 @@ def main():
         if((args.setting != 'all') and (epoch % args.val_every == 0)):
             trainer.validate()
 
-        if (parallel == True):
-            if (bool(args.zero_redundancy_optimizer) == True):
-                '''
-                    The argument 0 specifies that the consolidated state should be gathered on GPU 0. 
-                    This step is required to save the complete optimizer state when using the zero redundancy optimizer.
-                '''
-                optimizer.consolidate_state_dict(0) # To save the whole optimizer we need to gather it on GPU 0.
-            if (rank == 0):
-                trainer.save()
-        else:
-            trainer.save()
+        # Every rank takes part in saving, rank 0 writes the model and each rank might write its optimizer shard.
+        # The resume state of every rank is written with it and refers to these files.
+        trainer.save()
+
+    # Wait until the last checkpoint is on disk.
+    trainer.checkpoint_writer.close()
 
 class Engine(object):
     """
     Engine that runs training.
     """
 
-    def __init__(self, model, optimizer, dataloader_train, dataloader_val, args, config, writer, device, rank=0, world_size=1, parallel=False, cur_epoch=0):
+    def __init__(self, model, optimizer, dataloader_train, dataloader_val, args, config, writer, device, rank=0, world_size=1, parallel=False, cur_epoch=0, generator=None, sampler_train=None):
         self.cur_epoch = cur_epoch
         self.bestval_epoch = cur_epoch
         self.train_loss = []
         self.val_loss = []
         self.bestval = 1e10
+        self.global_step = 0
+        # Epochs at which the learning rate schedule was already applied.
+        self.lr_reductions = []
+        # State needed to continue an epoch at a step index, set by load_resume_state.
+        self.generator = generator
+        self.sampler_train = sampler_train
+        self.epoch_generator_state = None
+        self.resume_step = 0
+        self.resume_losses = None
         self.model = model
         self.optimizer = optimizer
         self.dataloader_train = dataloader_train
@@ -354,9 +433,21 @@ class Engine(object):
         self.world_size = world_size
         self.parallel = parallel
         self.vis_save_path = self.args.logdir + r'/visualizations'
+        trace_dir = os.path.join(self.args.logdir, 'trace_rank%d' % self.rank)
+        self.profiler = StepProfiler(self.device, enabled=bool(self.args.profile), trace_steps=self.args.profile_trace_steps, trace_dir=trace_dir)
+        self.profile_history = []
+        # The resume states go through the same writer, so they are written in order and after the files they refer to.
+        self.checkpoint_writer = CheckpointWriter(keep_last_k=self.args.keep_last_k, asynchronous=bool(self.args.async_checkpoint))
+        # Checkpoints written before a --resume are part of the retention policy as well.
+        self.checkpoint_writer.track_existing(self.checkpoint_patterns())
         if(self.config.debug == True):
             pathlib.Path(self.vis_save_path).mkdir(parents=True, exist_ok=True)
 
+        amp_dtypes = {'off': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+        self.amp_dtype = amp_dtypes[self.args.amp]
+        # Loss scaling is only needed for fp16, bf16 has the same exponent range as fp32.
+        self.scaler = torch.cuda.amp.GradScaler(enabled=(self.args.amp == 'fp16') and (self.device.type == 'cuda'))
+
         self.detailed_losses         = config.detailed_losses
         if self.args.wp_only:
             detailed_losses_weights = [1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
@@ -368,55 +459,85 @@ class Engine(object):
         # the values: are taken from detailed_losses_weights
         self.detailed_weights = {key: detailed_losses_weights[idx] for idx, key in enumerate(self.detailed_losses)}
 
-    def load_data_compute_loss(self, data):
-        # Move data to GPU
-        rgb = data['rgb'].to(self.device, dtype=torch.float32)
+    def load_data(self, data, non_blocking=False):
+        """
+        Moves a batch coming from the dataloader to the device of this process.
+        With non_blocking=True and pinned memory the copies are asynchronous with respect to the host.
+        """
+        batch = {}
+        batch['rgb'] = data['rgb'].to(self.device, dtype=torch.float32, non_blocking=non_blocking)
         if self.config.multitask:
-            depth = data['depth'].to(self.device, dtype=torch.float32)
+            batch['depth'] = data['depth'].to(self.device, dtype=torch.float32, non_blocking=non_blocking)
             # squeeze(1): 从张量中删除索引 1 处的单例维度。这通常在处理具有额外维度的张量时使用，但它代表一个单一维度并且不需要。
             # The torch.long data type is commonly used for integer values
-            semantic = data['semantic'].squeeze(1).to(self.device, dtype=torch.long)
+            batch['semantic'] = data['semantic'].squeeze(1).to(self.device, dtype=torch.long, non_blocking=non_blocking)
+        else:
+            batch['depth'] = None
+            batch['semantic'] = None
+
+        batch['bev'] = data['bev'].to(self.device, dtype=torch.long, non_blocking=non_blocking)
+
+        if ((self.config.use_point_pillars == True) and ('lidar_offsets' in data)):
+            # Ragged batch from PackedPointsCollate, padded on the GPU to the largest cloud of the batch.
+            # The point pillar encoder only reads the first num_points points of every sample.
+            batch['lidar'] = unpack_points(data['lidar_raw'], data['lidar_offsets'], self.device, non_blocking=non_blocking)
+            batch['num_points'] = data['num_points'].to(self.device, dtype=torch.int32, non_blocking=non_blocking)
+        elif (self.config.use_point_pillars == True):
+            batch['lidar'] = data['lidar_raw'].to(self.device, dtype=torch.float32, non_blocking=non_blocking)
+            batch['num_points'] = data['num_points'].to(self.device, dtype=torch.int32, non_blocking=non_blocking)
         else:
-            depth = None
-            semantic = None
+            batch['lidar'] = data['lidar'].to(self.device, dtype=torch.float32, non_blocking=non_blocking)
+            batch['num_points'] = None
 
-        bev = data['bev'].to(self.device, dtype=torch.long)
+        batch['label'] = data['label'].to(self.device, dtype=torch.float32, non_blocking=non_blocking)
+        batch['ego_waypoint'] = data['ego_waypoint'].to(self.device, dtype=torch.float32, non_blocking=non_blocking)
 
-        if (self.config.use_point_pillars == True):
-            lidar = data['lidar_raw'].to(self.device, dtype=torch.float32)
-            num_points = data['num_points'].to(self.device, dtype=torch.int32)
-        else:
-            lidar = data['lidar'].to(self.device, dtype=torch.float32)
-            num_points = None
+        batch['target_point'] = data['target_point'].to(self.device, dtype=torch.float32, non_blocking=non_blocking)
+        batch['target_point_image'] = data['target_point_image'].to(self.device, dtype=torch.float32, non_blocking=non_blocking)
 
-        label = data['label'].to(self.device, dtype=torch.float32)
-        ego_waypoint = data['ego_waypoint'].to(self.device, dtype=torch.float32)
+        batch['ego_vel'] = data['speed'].to(self.device, dtype=torch.float32, non_blocking=non_blocking)
 
-        target_point = data['target_point'].to(self.device, dtype=torch.float32)
-        target_point_image = data['target_point_image'].to(self.device, dtype=torch.float32)
+        if (self.args.backbone == 'geometric_fusion'):
+            batch['bev_points'] = data['bev_points'].to(self.device, dtype=torch.int64, non_blocking=non_blocking)
+            batch['cam_points'] = data['cam_points'].to(self.device, dtype=torch.int64, non_blocking=non_blocking)
 
-        ego_vel = data['speed'].to(self.device, dtype=torch.float32)
+        return batch
 
+    def compute_loss(self, batch):
         if ((self.args.backbone == 'transFuser') or (self.args.backbone == 'late_fusion') or (self.args.backbone == 'latentTF')):
-            losses = self.model(rgb, lidar, ego_waypoint=ego_waypoint, target_point=target_point,
-                           target_point_image=target_point_image,
-                           ego_vel=ego_vel.reshape(-1, 1), bev=bev,
-                           label=label, save_path=self.vis_save_path,
-                           depth=depth, semantic=semantic, num_points=num_points)
+            losses = self.model(batch['rgb'], batch['lidar'], ego_waypoint=batch['ego_waypoint'], target_point=batch['target_point'],
+                           target_point_image=batch['target_point_image'],
+                           ego_vel=batch['ego_vel'].reshape(-1, 1), bev=batch['bev'],
+                           label=batch['label'], save_path=self.vis_save_path,
+                           depth=batch['depth'], semantic=batch['semantic'], num_points=batch['num_points'])
         elif (self.args.backbone == 'geometric_fusion'):
-            bev_points = data['bev_points'].long().to('cuda', dtype=torch.int64)
-            cam_points = data['cam_points'].long().to('cuda', dtype=torch.int64)
-            losses = self.model(rgb, lidar, ego_waypoint=ego_waypoint, target_point=target_point,
-                           target_point_image=target_point_image,
-                           ego_vel=ego_vel.reshape(-1, 1), bev=bev,
-                           label=label, save_path=self.vis_save_path,
-                           depth=depth, semantic=semantic, num_points=num_points,
-                           bev_points=bev_points, cam_points=cam_points)
+            losses = self.model(batch['rgb'], batch['lidar'], ego_waypoint=batch['ego_waypoint'], target_point=batch['target_point'],
+                           target_point_image=batch['target_point_image'],
+                           ego_vel=batch['ego_vel'].reshape(-1, 1), bev=batch['bev'],
+                           label=batch['label'], save_path=self.vis_save_path,
+                           depth=batch['depth'], semantic=batch['semantic'], num_points=batch['num_points'],
+                           bev_points=batch['bev_points'], cam_points=batch['cam_points'])
         else:
-            raise ("The chosen vision backbone does not exist. The options are: transFuser, late_fusion, geometric_fusion, latentTF")
+            raise ValueError("The chosen vision backbone does not exist. The options are: transFuser, late_fusion, geometric_fusion, latentTF")
 
         return losses
 
+    def load_data_compute_loss(self, data):
+        # Move data to GPU
+        return self.compute_loss(self.load_data(data))
+
+    def prefetch(self, dataloader, profile=False):
+        """
+        Iterates over the dataloader and returns batches that are already on the device.
+        """
+        load_fn = self.profiled_load_data if (profile == True) else self.load_data
+        return BatchPrefetcher(dataloader, load_fn, self.device, num_batches=self.args.prefetch_batches)
+
+    def profiled_load_data(self, data, non_blocking=False):
+        # With the prefetcher the copy runs on the side stream, the events are recorded on that stream as well.
+        with self.profiler.stage('h2d'):
+            return self.load_data(data, non_blocking=non_blocking)
+
 
     '''
         iterates over the training data, computes the losses, performs backpropagation, and updates the model parameters. 
@@ -425,44 +546,89 @@ class Engine(object):
     def train(self):
         self.model.train()
 
-        # tracks the number of batches processed during the training loop
-        num_batches = 0
-        # accumulates the total loss across all batches for the current epoch.
-        loss_epoch = 0.0
-        # This dictionary initializes the detailed losses for the current epoch to 0.0
-        detailed_losses_epoch  = {key: 0.0 for key in self.detailed_losses}
+        # Sums up the losses on the device, they are only copied to the host once at the end of the epoch.
+        accumulator = LossAccumulator(self.detailed_losses, self.device)
         self.cur_epoch += 1
 
+        # When resuming in the middle of an epoch the sampler skips the first start_step batches.
+        start_step = self.resume_step
+        self.resume_step = 0
+        if (self.resume_losses is not None):
+            accumulator.load(self.resume_losses)
+            self.resume_losses = None
+        if ((start_step == 0) and (self.generator is not None)):
+            # The shuffle order and the worker seeds of the epoch are drawn from the generator when the dataloader is iterated.
+            self.epoch_generator_state = self.generator.get_state()
+        steps_since_checkpoint = 0
+
+        num_steps = start_step + len(self.dataloader_train)
+        accum_steps = self.args.grad_accum_steps
+        num_samples = 0
+        if (self.device.type == 'cuda'):
+            torch.cuda.reset_peak_memory_stats(self.device)
+        start_time = time.perf_counter()
+
         # Train loop
-        for data in tqdm(self.dataloader_train):
-            # This line clears the gradients of all model parameters. 
-            # It sets the gradients to None instead of 0 to optimize memory usage.
-            self.optimizer.zero_grad(set_to_none=True)
-            # loads the data and computes the losses for the current batch
-            losses = self.load_data_compute_loss(data)
-            # initializes the total loss for the current batch to 0.0. 
-            # It creates a tensor with value 0.0 and moves it to the device specified by self.device.
-            loss = torch.tensor(0.0).to(self.device, dtype=torch.float32)
-
-            # The code enters a nested loop to calculate the weighted sum of losses for each detailed loss.
-            for key, value in losses.items():
-                # calculates the weighted loss for each detailed loss. 
-                # It multiplies the value of the loss by the corresponding weight
-                loss += self.detailed_weights[key] * value
-                detailed_losses_epoch[key] += float(self.detailed_weights[key] * value.item())
-            
-            # This line performs backpropagation by 
-            # computing the gradients of the loss with respect to the model parameters.
-            loss.backward()
-            
-            # updates the model parameters 
-            # by taking a step in the optimizer's direction using the computed gradients
-            self.optimizer.step()
-            # increments the num_batches counter by 1 for each processed batch.
-            num_batches += 1
-            loss_epoch += float(loss.item())
-
-        self.log_losses(loss_epoch, detailed_losses_epoch, num_batches, '')
+        # This line clears the gradients of all model parameters. 
+        # It sets the gradients to None instead of 0 to optimize memory usage.
+        self.optimizer.zero_grad(set_to_none=True)
+        # The profiler measures how long each step waits for the next batch.
+        batches = self.profiler.iterate(tqdm(self.prefetch(self.dataloader_train, profile=True)))
+        for step, batch in enumerate(batches, start=start_step):
+            # The optimizer only steps at the end of every accumulation window.
+            # The last window of the epoch can be shorter, the loss is scaled by its actual length.
+            window_start = step - (step % accum_steps)
+            window_size = min(accum_steps, num_steps - window_start)
+            is_update_step = (step + 1 == window_start + window_size)
+
+            # DDP all reduces the gradients in every backward pass, which is only needed before an optimizer step.
+            if ((self.parallel == True) and (is_update_step == False)):
+                sync_context = self.model.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
+
+            with sync_context:
+                with self.profiler.stage('forward'), self.autocast():
+                    # computes the losses for the current batch, the data was already moved to the GPU by the prefetcher
+                    losses = self.compute_loss(batch)
+                    # calculates the weighted sum of the detailed losses.
+                    loss = self.weighted_loss(losses)
+
+                # This line performs backpropagation by 
+                # computing the gradients of the loss with respect to the model parameters.
+                # With fp16 the loss is scaled to avoid underflowing gradients.
+                with self.profiler.stage('backward'):
+                    self.scaler.scale(loss / window_size).backward()
+
+            with self.profiler.stage('optimizer'):
+                if (is_update_step == True):
+                    # updates the model parameters 
+                    # by taking a step in the optimizer's direction using the computed gradients.
+                    # The scaler unscales the gradients first and skips the step if they contain infs or NaNs.
+                    # The gradients are identical on all ranks after the all reduce, so all ranks skip the same steps,
+                    # which also holds for the ZeroRedundancyOptimizer.
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                    self.optimizer.zero_grad(set_to_none=True)
+
+            with self.profiler.stage('logging'):
+                accumulator.add(loss, losses, self.detailed_weights)
+                num_samples += batch['rgb'].shape[0]
+                self.global_step += 1
+                self.log_step(loss)
+            self.profiler.step()
+
+            # Mid epoch resume states are only written after an optimizer step, so no accumulated gradients are lost.
+            steps_since_checkpoint += 1
+            if ((self.args.checkpoint_every_n_steps > 0) and (steps_since_checkpoint >= self.args.checkpoint_every_n_steps)
+                    and (is_update_step == True) and (step + 1 < num_steps)):
+                self.save_resume_state(step=step + 1, accumulator=accumulator)
+                steps_since_checkpoint = 0
+
+        self.log_throughput(num_samples, start_time)
+        self.log_profile(num_samples, start_time)
+
+        self.log_losses(accumulator, '')
 
 
     '''
@@ -473,66 +639,744 @@ class Engine(object):
     def validate(self):
         self.model.eval()
 
-        num_batches = 0
-        loss_epoch = 0.0
-        detailed_val_losses_epoch  = {key: 0.0 for key in self.detailed_losses}
+        accumulator = LossAccumulator(self.detailed_losses, self.device)
 
         # Evaluation loop loop
-        for data in tqdm(self.dataloader_val):
-            losses = self.load_data_compute_loss(data)
+        for batch in tqdm(self.prefetch(self.dataloader_val)):
+            with self.autocast():
+                losses = self.compute_loss(batch)
+                loss = self.weighted_loss(losses)
+            accumulator.add(loss, losses, self.detailed_weights)
+
+        val_loss, _ = self.log_losses(accumulator, 'val_')
+        # The averages are available on every rank, so all ranks agree on the best epoch.
+        if (val_loss < self.bestval):
+            self.bestval = val_loss
+            self.bestval_epoch = self.cur_epoch
+
+    def autocast(self):
+        # Runs the forward pass in the precision chosen with --amp. With --amp off this does nothing.
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=(self.amp_dtype is not None))
+
+    def log_throughput(self, num_samples, start_time):
+        if (self.device.type == 'cuda'):
+            torch.cuda.synchronize(self.device)
+            peak_memory = torch.cuda.max_memory_allocated(self.device) / 1024 ** 3
+        else:
+            peak_memory = 0.0
+        samples_per_second = num_samples / max(time.perf_counter() - start_time, 1e-9)
+        print('Rank %d, amp %s, grad_accum_steps %d: %.1f samples/s, peak memory %.2f GB' %
+              (self.rank, self.args.amp, self.args.grad_accum_steps, samples_per_second, peak_memory))
+        if (self.rank == 0):
+            self.writer.add_scalar('throughput_samples_per_second', samples_per_second, self.cur_epoch)
+            self.writer.add_scalar('peak_memory_gb', peak_memory, self.cur_epoch)
+
+    def log_profile(self, num_samples, start_time):
+        if (self.profiler.enabled == False):
+            return
+        elapsed = time.perf_counter() - start_time
+        summary = self.profiler.summary()
+        summary['epoch'] = self.cur_epoch
+        summary['rank'] = self.rank
+        summary['samples'] = num_samples
+        summary['samples_per_second'] = num_samples / max(elapsed, 1e-9)
+
+        # Collects the throughput of every rank, a slow rank holds back all others in DDP.
+        per_rank = torch.zeros(self.world_size, device=self.device, dtype=torch.float64)
+        per_rank[self.rank] = summary['samples_per_second']
+        if (self.parallel == True):
+            torch.distributed.all_reduce(per_rank, op=torch.distributed.ReduceOp.SUM)
+        summary['samples_per_second_per_rank'] = per_rank.cpu().tolist()
 
-            loss = torch.tensor(0.0).to(self.device, dtype=torch.float32)
+        self.profile_history.append(summary)
+        with open(os.path.join(self.args.logdir, 'profile_rank%d.json' % self.rank), 'w') as f:
+            json.dump(self.profile_history, f, indent=2)
 
-            for key, value in losses.items():
-                loss += self.detailed_weights[key] * value
-                detailed_val_losses_epoch[key] += float(self.detailed_weights[key] * value.item())
+        if (self.rank == 0):
+            for stage, value in summary['stage_ms_per_step'].items():
+                self.writer.add_scalar('profile/' + stage + '_ms', value, self.cur_epoch)
+            for rank, value in enumerate(summary['samples_per_second_per_rank']):
+                self.writer.add_scalar('profile/samples_per_second_rank%d' % rank, value, self.cur_epoch)
+
+    def weighted_loss(self, losses):
+        # It multiplies the value of each detailed loss by the corresponding weight and sums them up.
+        loss = torch.zeros((), device=self.device, dtype=torch.float32)
+        for key, value in losses.items():
+            loss = loss + self.detailed_weights[key] * value
+        return loss
+
+    def log_step(self, loss):
+        # Optional step level logging. Calling item() synchronizes with the GPU, so this is only done every n steps.
+        if ((self.args.log_every_n_steps > 0) and (self.global_step % self.args.log_every_n_steps == 0) and (self.rank == 0)):
+            self.writer.add_scalar('step_loss_total', loss.item(), self.global_step)
+
+    def log_losses(self, accumulator, prefix=''):
+        """
+        Averages the losses of the epoch over all batches of all ranks and logs them on rank 0.
+        The averages are also returned on every rank.
+        """
+        # Packs [total, detailed losses in the order of config.detailed_losses, num_batches] into one tensor,
+        # so that parallel training only needs a single all_reduce.
+        packed = accumulator.pack()
+        if (self.parallel == True):
+            torch.distributed.all_reduce(packed, op=torch.distributed.ReduceOp.SUM)
+        packed = packed.cpu().tolist()
 
-            num_batches += 1
-            loss_epoch += float(loss.item())
+        # Summing the per batch losses and the batch counts before dividing weights every batch equally,
+        # even if the ranks processed a different number of batches.
+        num_batches = max(packed[-1], 1.0)
+        loss_epoch = packed[0] / num_batches
+        detailed_losses_epoch = {key: packed[idx + 1] / num_batches for idx, key in enumerate(accumulator.keys)}
 
-        self.log_losses(loss_epoch, detailed_val_losses_epoch, num_batches, 'val_')
+        if (self.rank == 0):
+            # Log main loss
+            self.writer.add_scalar(prefix + 'loss_total', loss_epoch, self.cur_epoch)
 
-    def log_losses(self, loss_epoch, detailed_losses_epoch, num_batches, prefix=''):
-        # Average all the batches into one number
-        loss_epoch = loss_epoch / num_batches
-        for key, value in detailed_losses_epoch.items():
-            detailed_losses_epoch[key] = value / num_batches
+            # Log detailed losses
+            for key, value in detailed_losses_epoch.items():
+                self.writer.add_scalar(prefix + key, value, self.cur_epoch)
 
-        # In parallel training aggregate all values onto the master node.
+        return loss_epoch, detailed_losses_epoch
 
-        gathered_detailed_losses = [None for _ in range(self.world_size)]
-        gathered_loss = [None for _ in range(self.world_size)]
+    def save(self):
+        """
+        Snapshots the model and optimizer state to the CPU and hands it to the checkpoint writer together with
+        the resume state of this rank, which refers to the written model and optimizer files.
+        Needs to be called on every rank.
+        """
+        is_zero = isinstance(self.optimizer, ZeroRedundancyOptimizer)
+        sharded = (self.args.checkpoint_format == 'sharded') and is_zero
+        if (is_zero == True) and (sharded == False):
+            '''
+                The argument 0 specifies that the consolidated state should be gathered on GPU 0. 
+                This step is required to save the complete optimizer state when using the zero redundancy optimizer.
+            '''
+            self.optimizer.consolidate_state_dict(0) # To save the whole optimizer we need to gather it on GPU 0.
 
-        if (self.parallel == True):
-            torch.distributed.gather_object(obj=detailed_losses_epoch,
-                                            object_gather_list=gathered_detailed_losses if self.rank == 0 else None, 
-                                            dst=0)
-            torch.distributed.gather_object(obj=loss_epoch, 
-                                            object_gather_list=gathered_loss if self.rank == 0 else None,
-                                            dst=0)
-        else:
-            gathered_detailed_losses[0] = detailed_losses_epoch
-            gathered_loss[0] = loss_epoch
-            
+        files = []
+        checkpoint_files = {}
         if (self.rank == 0):
-            # Log main loss
-            aggregated_total_loss = sum(gathered_loss) / len(gathered_loss)
-            self.writer.add_scalar(prefix + 'loss_total', aggregated_total_loss, self.cur_epoch)
+            # NOTE saving the model with torch.save(model.module.state_dict(), PATH) if parallel processing is used would be cleaner, we keep it for backwards compatibility
+            checkpoint_files['model_file'] = 'model_%d.pth' % self.cur_epoch
+            files.append((os.path.join(self.args.logdir, checkpoint_files['model_file']), self.model.state_dict()))
+        if (sharded == True):
+            # Every rank writes the optimizer state of its own parameter partition, no consolidation needed.
+            checkpoint_files['optimizer_shard_file'] = 'optimizer_%d_rank%d.pth' % (self.cur_epoch, self.rank)
+            files.append((os.path.join(self.args.logdir, checkpoint_files['optimizer_shard_file']), self.optimizer.optim.state_dict()))
+        elif (self.rank == 0):
+            checkpoint_files['optimizer_file'] = 'optimizer_%d.pth' % self.cur_epoch
+            files.append((os.path.join(self.args.logdir, checkpoint_files['optimizer_file']), self.optimizer.state_dict()))
+
+        # The resume state is overwritten every epoch, it is not part of the retention policy.
+        resume_state = self.resume_state(checkpoint_files=checkpoint_files)
+        self.checkpoint_writer.submit(self.cur_epoch, files, untracked=[(self.resume_file(self.rank), resume_state)])
+
+    def checkpoint_patterns(self):
+        # The files written by save on this rank, the group of a pattern is the epoch.
+        patterns = [r'optimizer_(\d+)_rank%d\.pth' % self.rank]
+        if (self.rank == 0):
+            patterns += [r'model_(\d+)\.pth', r'optimizer_(\d+)\.pth']
+        return [os.path.join(self.args.logdir, pattern) for pattern in patterns]
+
+    def resume_file(self, rank):
+        return os.path.join(self.args.logdir, 'resume_state_rank%d.pth' % rank)
+
+    def save_resume_state(self, step, accumulator):
+        """
+        Writes the resume state in the middle of the current epoch after step batches. Unlike the state written
+        by save at the end of an epoch it contains its own copy of the model and optimizer.
+        Needs to be called on every rank.
+        """
+        is_zero = isinstance(self.optimizer, ZeroRedundancyOptimizer)
+        sharded = (self.args.checkpoint_format == 'sharded') and is_zero
+        if (is_zero == True) and (sharded == False):
+            self.optimizer.consolidate_state_dict(0)
+        state = self.resume_state(step=step, accumulator=accumulator)
+        self.checkpoint_writer.submit(self.cur_epoch, [], untracked=[(self.resume_file(self.rank), state)])
+
+    def resume_state(self, step=0, accumulator=None, checkpoint_files=None):
+        """
+        Everything needed to continue the training: model, optimizer, gradient scaler, random number generators,
+        learning rate schedule and best validation loss. Every rank writes its own file with its random states,
+        rank 0 adds the model and the shared training state. Every file stores the epoch and step, so files of
+        different ranks written at different times are detected when loading.
+        step > 0 marks a state written in the middle of the current epoch after that many batches.
+        checkpoint_files names the model and optimizer files written together with the state at the end of an epoch,
+        they are referred to instead of copying the model and optimizer again.
+        """
+        is_zero = isinstance(self.optimizer, ZeroRedundancyOptimizer)
+        sharded = (self.args.checkpoint_format == 'sharded') and is_zero
+
+        state = {
+            'torch_rng_state': torch.get_rng_state(),
+            'numpy_rng_state': np.random.get_state(),
+            'random_rng_state': random.getstate(),
+        }
+        if (self.device.type == 'cuda'):
+            state['cuda_rng_state'] = torch.cuda.get_rng_state(self.device)
+        if (self.generator is not None):
+            # In the middle of an epoch the state from the epoch start is needed to reproduce the shuffle order.
+            state['generator_state'] = self.epoch_generator_state if (step > 0) else self.generator.get_state()
+        if (checkpoint_files is not None):
+            state.update(checkpoint_files)
+        elif (sharded == True):
+            state['optimizer_shard'] = self.optimizer.optim.state_dict()
+
+        # cur_epoch was already incremented at the start of an unfinished epoch.
+        state['epoch'] = (self.cur_epoch - 1) if (step > 0) else self.cur_epoch
+        state['step'] = step
+        if (self.rank == 0):
+            if (checkpoint_files is None):
+                state['model'] = self.model.state_dict()
+                if (sharded == False):
+                    state['optimizer'] = self.optimizer.state_dict()
+            state['scaler'] = self.scaler.state_dict()
+            state['global_step'] = self.global_step
+            state['lr_reductions'] = list(self.lr_reductions)
+            state['bestval'] = self.bestval
+            state['bestval_epoch'] = self.bestval_epoch
+        if (step > 0):
+            # Every rank continues its own running loss sums.
+            state['losses'] = accumulator.pack()
+        return state
+
+    def load_resume_state(self):
+        common = torch.load(self.resume_file(0), map_location='cpu')
+        local = common if (self.rank == 0) else torch.load(self.resume_file(self.rank), map_location='cpu')
+        if ((local['epoch'], local['step']) != (common['epoch'], common['step'])):
+            raise RuntimeError('The resume state of rank %d is from epoch %d step %d, but the one of rank 0 from epoch %d step %d. '
+                               'The job was probably preempted while the states were written.'
+                               % (self.rank, local['epoch'], local['step'], common['epoch'], common['step']))
+
+        def load_file(name):
+            return torch.load(os.path.join(self.args.logdir, name), map_location='cpu')
+
+        # States written at the end of an epoch refer to the model and optimizer checkpoint of that epoch.
+        self.model.load_state_dict(load_file(common['model_file']) if ('model_file' in common) else common['model'])
+        if ('optimizer_shard_file' in local):
+            apply_optimizer_state(self.optimizer, load_file(local['optimizer_shard_file']), sharded=True)
+        elif ('optimizer_shard' in local):
+            apply_optimizer_state(self.optimizer, local['optimizer_shard'], sharded=True)
+        elif ('optimizer_file' in common):
+            apply_optimizer_state(self.optimizer, load_file(common['optimizer_file']), sharded=False)
+        else:
+            apply_optimizer_state(self.optimizer, common['optimizer'], sharded=False)
+        # A disabled scaler saves an empty state, e.g. when the training ran without --amp fp16.
+        if ((len(common['scaler']) > 0) and (self.scaler.is_enabled() == True)):
+            self.scaler.load_state_dict(common['scaler'])
+
+        self.cur_epoch = common['epoch']
+        self.resume_step = common['step']
+        self.global_step = common['global_step']
+        self.lr_reductions = list(common['lr_reductions'])
+        self.bestval = common['bestval']
+        self.bestval_epoch = common['bestval_epoch']
+
+        torch.set_rng_state(local['torch_rng_state'])
+        np.random.set_state(local['numpy_rng_state'])
+        random.setstate(local['random_rng_state'])
+        if (('cuda_rng_state' in local) and (self.device.type == 'cuda')):
+            torch.cuda.set_rng_state(local['cuda_rng_state'], self.device)
+        if ((self.generator is not None) and ('generator_state' in local)):
+            self.generator.set_state(local['generator_state'])
+            self.epoch_generator_state = local['generator_state']
+
+        if (self.resume_step > 0):
+            self.resume_losses = local['losses'].to(self.device)
+            self.sampler_train.skip_batches(self.resume_step, self.args.batch_size)
+        print('Resuming at epoch %d, step %d' % (self.cur_epoch, self.resume_step))
+
+
+class StepProfiler(object):
+    """
+    Records the time spent in the stages of a training step: data wait, host to device copy, forward, backward,
+    optimizer step and logging. GPU stages are timed with CUDA events, which are only read out every
+    resolve_every stages to avoid synchronizing in every step. On the CPU perf_counter is used.
+    The data stage is the host time spent waiting for the next batch, without the time it takes to issue
+    the host to device copy of the following batch, which the prefetcher starts inside next().
+    Optionally captures a torch.profiler trace for a window of steps.
+    """
 
-            # Log detailed losses
-            for key, value in detailed_losses_epoch.items():
-                aggregated_value = 0.0
-                for i in range(self.world_size):
-                    aggregated_value += gathered_detailed_losses[i][key]
+    def __init__(self, device, enabled=False, trace_steps='', trace_dir=None, resolve_every=1000):
+        self.enabled = enabled
+        self.device = device
+        self.use_cuda = enabled and (device.type == 'cuda')
+        # Host time spent inside GPU timed stages, subtracted from the data stage they are nested in.
+        self.host_stage_ms = 0.0
+        self.resolve_every = resolve_every
+        self.pending = []
+        self.reset()
+
+        # trace_steps: 'start,end' range of training steps that are captured with torch.profiler.
+        self.trace = None
+        if (trace_steps != ''):
+            start, end = [int(x) for x in trace_steps.split(',')]
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if (device.type == 'cuda'):
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=max(start - 1, 0), warmup=min(start, 1), active=end - start, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir))
+            self.trace.start()
+            self.trace_end = end
+
+    def reset(self):
+        self.totals = collections.defaultdict(float)
+        self.num_steps = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if (self.enabled == False):
+            yield
+        elif (self.use_cuda == True):
+            # Events are recorded on the current stream, which is the side stream inside the prefetcher.
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start_time = time.perf_counter()
+            start.record()
+            yield
+            end.record()
+            self.host_stage_ms += (time.perf_counter() - start_time) * 1000.0
+            self.pending.append((name, start, end))
+            if (len(self.pending) >= self.resolve_every):
+                self.resolve()
+        else:
+            start_time = time.perf_counter()
+            yield
+            self.totals[name] += (time.perf_counter() - start_time) * 1000.0
+
+    def iterate(self, iterable):
+        # The time spent waiting for the next batch is measured on the host.
+        if (self.enabled == False):
+            return iterable
+        return self._iterate(iterable)
+
+    def _iterate(self, iterable):
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            nested_ms = self.host_stage_ms
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.totals['data'] += (time.perf_counter() - start_time) * 1000.0 - (self.host_stage_ms - nested_ms)
+            yield item
+
+    def step(self):
+        self.num_steps += 1
+        if (self.trace is not None):
+            self.trace.step()
+            if (self.trace.step_num >= self.trace_end):
+                self.trace.stop()
+                self.trace = None
+
+    def resolve(self):
+        if (len(self.pending) == 0):
+            return
+        # The h2d events are recorded on the prefetcher's side stream, which the compute stream does not
+        # wait on. Only a device wide synchronize guarantees that every pending event has completed.
+        torch.cuda.synchronize(self.device)
+        for name, start, end in self.pending:
+            self.totals[name] += start.elapsed_time(end)
+        self.pending = []
+
+    def summary(self):
+        # Average milliseconds per step for every stage, the totals are reset for the next epoch.
+        self.resolve()
+        num_steps = max(self.num_steps, 1)
+        summary = {'steps': self.num_steps,
+                   'stage_ms_per_step': {name: total / num_steps for name, total in self.totals.items()}}
+        self.reset()
+        return summary
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints in a background thread so that training continues while the files are written.
+    The state is copied to the CPU before submit returns. Every file is written to a temporary file
+    first, synced to disk and then renamed, so a checkpoint on disk is never partially written.
+    """
 
-                aggregated_value = aggregated_value / self.world_size
+    def __init__(self, keep_last_k=0, asynchronous=True):
+        # keep_last_k=0 keeps all checkpoints.
+        self.keep_last_k = keep_last_k
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if asynchronous else None
+        self.pending = None
+        self.saved = collections.deque()
+
+    def track_existing(self, patterns):
+        """
+        Adds the checkpoints already in the directories of patterns to the retention policy, so the files of a
+        previous run are deleted as well when training is resumed. patterns are regular expressions of the
+        file paths whose first group is the epoch.
+        """
+        epochs = collections.defaultdict(list)
+        for pattern in patterns:
+            directory, name = os.path.split(pattern)
+            if not os.path.isdir(directory):
+                continue
+            for file_name in os.listdir(directory):
+                match = re.fullmatch(name, file_name)
+                if (match is not None):
+                    epochs[int(match.group(1))].append(os.path.join(directory, file_name))
+        for epoch in sorted(epochs):
+            self.saved.append((epoch, epochs[epoch]))
+
+    def submit(self, epoch, files, untracked=()):
+        # Only one checkpoint is in flight at a time, which bounds the CPU memory used by the snapshots.
+        # untracked files are written after files and are not deleted by the retention policy.
+        self.wait()
+        files = [(path, snapshot_to_cpu(state)) for path, state in files]
+        untracked = [(path, snapshot_to_cpu(state)) for path, state in untracked]
+        if (self.executor is None):
+            self.write(epoch, files, untracked)
+        else:
+            self.pending = self.executor.submit(self.write, epoch, files, untracked)
+
+    def write(self, epoch, files, untracked=()):
+        directories = set()
+        for path, state in list(files) + list(untracked):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                torch.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            directories.add(os.path.dirname(path))
+        # The rename is only durable once the directory entry is synced as well.
+        for directory in directories:
+            fsync_directory(directory)
+
+        if ((self.keep_last_k > 0) and (len(files) > 0)):
+            # An epoch written again after a resume replaces its earlier entry.
+            self.saved = collections.deque(entry for entry in self.saved if entry[0] != epoch)
+            self.saved.append((epoch, [path for path, _ in files]))
+            while len(self.saved) > self.keep_last_k:
+                _, old_paths = self.saved.popleft()
+                for old_path in old_paths:
+                    if os.path.exists(old_path):
+                        os.remove(old_path)
+
+    def wait(self):
+        # Raises errors of the background write here instead of losing them.
+        if (self.pending is not None):
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        if (self.executor is not None):
+            self.executor.shutdown()
+
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def snapshot_to_cpu(state):
+    # Copies all tensors of a (nested) state dict, training keeps updating the original tensors in place.
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        return {key: snapshot_to_cpu(value) for key, value in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(snapshot_to_cpu(value) for value in state)
+    return state
+
+
+def load_optimizer_state(optimizer, optimizer_file, rank, device):
+    # Sharded checkpoints contain one file per rank with the state of the local ZeroRedundancyOptimizer partition.
+    # They can only be loaded with the same number of GPUs they were written with.
+    shard_file = optimizer_file.replace('.pth', '_rank%d.pth' % rank)
+    if isinstance(optimizer, ZeroRedundancyOptimizer) and os.path.isfile(shard_file):
+        apply_optimizer_state(optimizer, torch.load(shard_file, map_location=device), sharded=True)
+    else:
+        apply_optimizer_state(optimizer, torch.load(optimizer_file, map_location=device), sharded=False)
 
-                self.writer.add_scalar(prefix + key, aggregated_value, self.cur_epoch)
 
-    def save(self):
-        # NOTE saving the model with torch.save(model.module.state_dict(), PATH) if parallel processing is used would be cleaner, we keep it for backwards compatibility
-        torch.save(self.model.state_dict(), os.path.join(self.args.logdir, 'model_%d.pth' % self.cur_epoch))
-        torch.save(self.optimizer.state_dict(), os.path.join(self.args.logdir, 'optimizer_%d.pth' % self.cur_epoch))
+def apply_optimizer_state(optimizer, state, sharded=False):
+    if (sharded == True):
+        optimizer.optim.load_state_dict(state)
+        # The wrapper copies its param groups into the local optimizer before every step, so the learning rate is restored there as well.
+        for g in optimizer.param_groups:
+            g['lr'] = optimizer.optim.param_groups[0]['lr']
+    else:
+        optimizer.load_state_dict(state)
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    Wraps a sampler and can skip the first batches of the next epoch, which is used to resume in the middle of an epoch.
+    The skipped samples are only the same as before if the sampler draws the same order, e.g. the generator state was restored.
+    Works for samplers of indices and for batch samplers that yield lists of indices.
+    """
+
+    def __init__(self, sampler, batch_sampler=False):
+        self.sampler = sampler
+        self.batch_sampler = batch_sampler
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        self.sampler.set_epoch(epoch)
+
+    def skip_batches(self, num_batches, batch_size):
+        self.start_index = num_batches if (self.batch_sampler == True) else num_batches * batch_size
+
+    def __iter__(self):
+        # The skip only applies to the next epoch.
+        start_index = self.start_index
+        self.start_index = 0
+        return itertools.islice(iter(self.sampler), start_index, None)
+
+    def __len__(self):
+        return max(len(self.sampler) - self.start_index, 0)
+
+
+class PointCountBucketSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler that groups samples with a similar number of lidar points, so that the batches of the
+    point pillar encoder need little padding. The indices are shuffled and split across ranks like the
+    DistributedSampler, then sorted by point count inside chunks of bucket_size batches and cut into batches.
+    The order of the batches is shuffled again, so the batch sizes in points are not sorted over the epoch.
+    """
+
+    def __init__(self, point_counts, batch_size, num_replicas=1, rank=0, generator=None, seed=0, bucket_size=50):
+        self.point_counts = np.asarray(point_counts)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        # Without a generator the shuffle is seeded with seed + epoch, which is the same on all ranks.
+        self.generator = generator
+        self.seed = seed
+        self.bucket_size = bucket_size
+        self.epoch = 0
+        # Every rank gets the same number of samples, the last ones are repeated like in the DistributedSampler.
+        self.num_samples = int(np.ceil(len(self.point_counts) / self.num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if (self.generator is None):
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+        else:
+            generator = self.generator
+        indices = torch.randperm(len(self.point_counts), generator=generator).numpy()
+        total_size = self.num_samples * self.num_replicas
+        indices = np.resize(indices, total_size)
+        indices = indices[self.rank:total_size:self.num_replicas]
+
+        batches = []
+        chunk_size = self.batch_size * self.bucket_size
+        for start in range(0, len(indices), chunk_size):
+            chunk = indices[start:start + chunk_size]
+            chunk = chunk[np.argsort(self.point_counts[chunk], kind='stable')]
+            batches.extend(chunk[i:i + self.batch_size].tolist() for i in range(0, len(chunk), self.batch_size))
+
+        for i in torch.randperm(len(batches), generator=generator).tolist():
+            yield batches[i]
+
+    def __len__(self):
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+
+def get_point_counts(dataset):
+    # Packed datasets store the point counts in one array, reading them is cheap on every rank.
+    if ((not isinstance(dataset, PackedCARLA_Data)) or ('num_points' not in dataset.index['fields'])):
+        raise ValueError('The bucket sampler needs a dataset packed with --use_point_pillars 1 that has a num_points field.')
+    dataset.open()
+    point_counts = np.asarray(dataset.arrays['num_points']).reshape(-1)
+    dataset.arrays = None
+    return point_counts
+
+
+class PackedPointsCollate(object):
+    """
+    Collates the padded lidar_raw point clouds of the point pillar encoder into one ragged array.
+    Only the num_points valid points of every sample are kept, lidar_offsets marks where each sample starts.
+    All other fields are collated by base_collate.
+    """
+
+    def __init__(self, base_collate=None):
+        self.base_collate = base_collate if (base_collate is not None) else torch.utils.data.default_collate
+
+    def __call__(self, batch):
+        points = [np.asarray(sample['lidar_raw'])[:int(sample['num_points'])] for sample in batch]
+        others = self.base_collate([{key: value for key, value in sample.items() if key != 'lidar_raw'} for sample in batch])
+
+        counts = torch.tensor([len(p) for p in points], dtype=torch.int64)
+        others['lidar_raw'] = torch.from_numpy(np.concatenate(points, axis=0))
+        others['lidar_offsets'] = torch.cat([torch.zeros(1, dtype=torch.int64), torch.cumsum(counts, dim=0)])
+        return others
+
+
+def unpack_points(points, offsets, device, non_blocking=False):
+    """
+    Moves a ragged batch of points to the device and pads it there to the largest point cloud of the batch.
+    The offsets stay on the host, so the padded shape is known without a synchronization.
+    """
+    counts = offsets[1:] - offsets[:-1]
+    batch_size = len(counts)
+    total = int(offsets[-1])
+    max_points = int(counts.max()) if (batch_size > 0) else 0
+
+    points = points.to(device, dtype=torch.float32, non_blocking=non_blocking)
+    counts_device = counts.to(device, non_blocking=non_blocking)
+    starts_device = offsets[:-1].to(device, non_blocking=non_blocking)
+    # Sample index and position inside the sample of every point.
+    sample_ids = torch.repeat_interleave(torch.arange(batch_size, device=device), counts_device, output_size=total)
+    positions = torch.arange(total, device=device) - torch.repeat_interleave(starts_device, counts_device, output_size=total)
+
+    padded = torch.zeros((batch_size, max_points, points.shape[1]), device=device, dtype=torch.float32)
+    padded[sample_ids, positions] = points
+    return padded
+
+
+class LossAccumulator(object):
+    """
+    Running sums of the total loss and the weighted detailed losses that stay on the device.
+    Adding a batch does not synchronize with the GPU.
+    """
+
+    def __init__(self, keys, device):
+        self.keys = list(keys)
+        self.index = {key: idx for idx, key in enumerate(self.keys)}
+        # Entry 0 holds the total loss, the remaining entries the detailed losses in the order of keys.
+        self.sums = torch.zeros(len(self.keys) + 1, device=device, dtype=torch.float32)
+        self.num_batches = 0
+
+    def add(self, loss, losses, weights):
+        with torch.no_grad():
+            self.sums[0] += loss.detach().float()
+            for key, value in losses.items():
+                self.sums[self.index[key] + 1] += weights[key] * value.detach().float()
+        self.num_batches += 1
+
+    def load(self, packed):
+        self.sums.copy_(packed[:-1])
+        self.num_batches = int(packed[-1].item())
+
+    def pack(self):
+        # The batch count is appended as the last entry so that it can be reduced together with the sums.
+        num_batches = torch.full((1,), float(self.num_batches), device=self.sums.device, dtype=torch.float32)
+        return torch.cat([self.sums, num_batches])
+
+
+class BatchPrefetcher(object):
+    """
+    Wraps a dataloader and stages the next num_batches batches on the GPU with a side CUDA stream.
+    The host to device copies of batch N+1 then overlap with the forward and backward pass of batch N.
+    With num_batches=0 or on a CPU device the batches are moved synchronously, like before.
+    """
+
+    def __init__(self, dataloader, load_fn, device, num_batches=1):
+        self.dataloader = dataloader
+        self.load_fn = load_fn
+        self.device = device
+        self.num_batches = num_batches
+        self.use_stream = (num_batches > 0) and (device.type == 'cuda') and torch.cuda.is_available()
+        self.stream = torch.cuda.Stream(device=device) if self.use_stream else None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        if (self.use_stream == False):
+            for data in self.dataloader:
+                yield self.load_fn(data)
+            return
+
+        data_iter = iter(self.dataloader)
+        # Each entry is a staged batch together with the event marking the end of its copies on the side stream.
+        staged = collections.deque()
+
+        def stage_next():
+            try:
+                data = next(data_iter)
+            except StopIteration:
+                return
+            with torch.cuda.stream(self.stream):
+                batch = self.load_fn(data, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(self.stream)
+            staged.append((batch, event))
+
+        for _ in range(self.num_batches):
+            stage_next()
+
+        while len(staged) > 0:
+            batch, event = staged.popleft()
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            # The tensors were allocated on the side stream. record_stream prevents the caching allocator
+            # from handing out their memory again before the compute stream is done with them.
+            for value in batch.values():
+                if torch.is_tensor(value):
+                    value.record_stream(current_stream)
+            stage_next()
+            yield batch
+
+def make_dataloader(dataset, sampler, args, num_workers, generator, collate_fn=None):
+    kwargs = {}
+    if (isinstance(sampler, ResumableSampler) and (sampler.batch_sampler == True)):
+        # The sampler already forms the batches.
+        kwargs['batch_sampler'] = sampler
+    else:
+        kwargs['sampler'] = sampler
+        kwargs['batch_size'] = args.batch_size
+    if (num_workers > 0):
+        # Number of batches loaded in advance by each worker.
+        kwargs['prefetch_factor'] = args.prefetch_factor
+        # Keeps the worker processes alive between epochs instead of forking them again at the start of every epoch.
+        kwargs['persistent_workers'] = bool(args.persistent_workers)
+    return DataLoader(dataset, worker_init_fn=seed_worker, generator=generator,
+                      num_workers=num_workers, pin_memory=True, collate_fn=collate_fn, **kwargs)
+
+
+def autotune_num_workers(dataset, args, parallel, device, collate_fn=None):
+    """
+    Times the first --autotune_workers batches for a few worker counts and returns the fastest one.
+    In parallel training all ranks use the same worker count, chosen by the slowest rank.
+    """
+    # torchrun sets LOCAL_WORLD_SIZE, the CPUs of a node are shared by all of its processes.
+    cpus_per_process = max((os.cpu_count() or 1) // int(os.environ.get('LOCAL_WORLD_SIZE', 1)), 1)
+    candidates = [n for n in (0, 2, 4, 8, 12, 16) if n <= cpus_per_process]
+
+    timings = []
+    for num_workers in candidates:
+        # A separate generator, so that autotuning does not change the random state of the training.
+        generator = torch.Generator(device='cpu')
+        generator.manual_seed(0)
+        sampler = torch.utils.data.RandomSampler(dataset, generator=generator)
+        dataloader = make_dataloader(dataset, sampler, args, num_workers, generator, collate_fn)
+        data_iter = iter(dataloader)
+        # The first batch includes the worker start up, which is only paid once with persistent workers.
+        next(data_iter)
+        start_time = time.perf_counter()
+        for _ in range(args.autotune_workers):
+            try:
+                next(data_iter)
+            except StopIteration:
+                break
+        timings.append(time.perf_counter() - start_time)
+        del data_iter, dataloader
+
+    timings = torch.tensor(timings, device=device, dtype=torch.float64)
+    if (parallel == True):
+        torch.distributed.all_reduce(timings, op=torch.distributed.ReduceOp.MAX)
+    timings = timings.cpu().tolist()
+    best = candidates[timings.index(min(timings))]
+    print('Dataloader autotune:', ', '.join('%d workers %.2fs' % (n, t) for n, t in zip(candidates, timings)), '-> using', best)
+    return best
+
 
 # We need to seed the workers individually otherwise random processes in the dataloader return the same values across workers!
 '''